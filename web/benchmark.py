@@ -0,0 +1,257 @@
+import os, argparse, json, tempfile
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from osgeo import gdal, osr
+from shapely.geometry import MultiPolygon, box
+
+from delineation import delineate
+from delineation.profiling import Trace
+
+STAGES = ['regions', 'basins', 'mode', 'basin_search', 'grid_mask', 'grid_trace', 'grid_polygonize', 'raster_merge',
+          'union', 'serialize']
+
+# raster and vector merges of a point should agree in area within this fraction, and in number of parts
+AREA_TOLERANCE = 0.01
+
+# points on the real HydroSHEDS/HydroBASINS data, as (name, lat, lng), including those tried in test_function.py
+POINTS = [
+    ('HH', 37.91864, -119.65922),
+    ('Australia', -33.982, 115.765),
+    ('Colorado tributary above San Luis Rio Colorado', 32.52726, -114.79777),
+    ('Colorado River at San Luis Rio Colorado', 32.49434, -114.81376),
+    ('Rio San Juan', 25.70192, -99.27689),
+    ('Uganda - Ishango', -0.09742, 29.59311),
+    ('White Nile @ Uganda', 3.5856, 32.03533),
+    ('Nile @ Cairo', 30.01857, 31.21864),
+    ('Mississippi NOLA @ French Quarter', 29.95262, -90.06059),
+]
+
+# synthetic fixture: a square 'na' grid with a single north-south river down the middle column, and HydroBASINS
+# layers made of horizontal strips along the river, halved at each level
+FIXTURE_SIZE = 512
+FIXTURE_ORIGIN = (-121.0, 42.0)
+FIXTURE_LEVELS = 7
+CELL = 1.0 / 240
+
+
+def fixture_point(x, y):
+    """(lng, lat) of the center of a fixture cell"""
+    return FIXTURE_ORIGIN[0] + (x + 0.5) * CELL, FIXTURE_ORIGIN[1] - (y + 0.5) * CELL
+
+
+def fixture_points():
+    river = FIXTURE_SIZE // 2
+    cases = [
+        ('traditional small (hillslope, top strip)', 100, 3),
+        ('traditional medium (river, top strip)', river, FIXTURE_SIZE // 2 ** (FIXTURE_LEVELS - 1) - 1),
+        ('traditional small (hillslope, near outlet)', 50, FIXTURE_SIZE - 3),
+        ('hybrid small (river, near top)', river, 20),
+        ('hybrid medium (river, middle)', river, FIXTURE_SIZE // 2 + 5),
+        ('hybrid large (river, near outlet)', river, FIXTURE_SIZE - 3),
+    ]
+    return [(name, fixture_point(x, y)[1], fixture_point(x, y)[0]) for name, x, y in cases]
+
+
+def _write_grid(path, array, gdal_type):
+    driver = gdal.GetDriverByName('EHdr')
+    rows, cols = array.shape
+    dataset = driver.Create(path, cols, rows, 1, gdal_type)
+    dataset.SetGeoTransform((FIXTURE_ORIGIN[0], CELL, 0, FIXTURE_ORIGIN[1], 0, -CELL))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(array)
+    dataset.FlushCache()
+
+
+def _strips(level):
+    """HydroBASINS attributes and geometries for the strips at a level, north to south"""
+    n = 2 ** (level - 1)
+    rows = FIXTURE_SIZE // n
+    ids = [7000000000 + level * 100000 + k + 1 for k in range(n)]
+    records = []
+    for k in range(n):
+        # Pfafstetter digits: the downstream (southern) half of each strip is 1, the upstream half 2
+        digits = '7' + ''.join('2' if (k >> (level - 2 - j)) % 2 == 0 else '1' for j in range(level - 1))
+        west, north = FIXTURE_ORIGIN
+        east = west + FIXTURE_SIZE * CELL
+        top = north - k * rows * CELL
+        records.append({
+            'HYBAS_ID': ids[k],
+            'NEXT_DOWN': ids[k + 1] if k + 1 < n else 0,
+            'NEXT_SINK': ids[-1],
+            'MAIN_BAS': ids[-1],
+            'PFAF_ID': int(digits),
+            'SUB_AREA': 1.0,
+            'UP_AREA': float(k + 1),
+            'geometry': MultiPolygon([box(west, top - rows * CELL, east, top)]),
+        })
+    return records
+
+
+def make_fixture(path):
+    """Write a small synthetic data tree, laid out like the one init.py downloads, to path"""
+    hydrosheds = os.path.join(path, 'hydrosheds')
+    hydrobasins = os.path.join(path, 'hydrobasins')
+    for directory in [hydrosheds, hydrobasins]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    # flow directions: hillslopes drain east or west to the river, which drains south and off the grid
+    n = FIXTURE_SIZE
+    river = n // 2
+    fdir = np.zeros((n, n), dtype=np.uint8)
+    fdir[:, :river] = 1
+    fdir[:, river + 1:] = 16
+    fdir[:, river] = 4
+    _write_grid(os.path.join(hydrosheds, 'na_dir_15s.bil'), fdir, gdal.GDT_Byte)
+
+    # flow accumulation, not counting the cell itself
+    cols = np.arange(n)
+    acc = np.empty((n, n), dtype=np.int32)
+    acc[:, :river] = cols[:river]
+    acc[:, river + 1:] = (n - 1 - cols)[river + 1:]
+    acc[:, river] = (np.arange(n) + 1) * (n - 1) + np.arange(n)
+    _write_grid(os.path.join(hydrosheds, 'na_acc_15s.bil'), acc, gdal.GDT_Int32)
+
+    crs = {'init': 'epsg:4326'}
+    for level in range(1, FIXTURE_LEVELS + 1):
+        basins = gpd.GeoDataFrame(_strips(level), crs=crs)
+        basins.to_file(os.path.join(hydrobasins, 'hybas_na_lev{:02}_v1c.shp'.format(level)))
+
+    # level 0 is the finest level, with the Pfafstetter code of every coarser level
+    level00 = gpd.GeoDataFrame(_strips(FIXTURE_LEVELS), crs=crs)
+    for level in range(1, FIXTURE_LEVELS + 1):
+        level00['PFAF_{}'.format(level)] = level00['PFAF_ID'].astype(str).str[:level].astype(int)
+    level00.to_file(os.path.join(hydrobasins, 'hybas_na_lev00_v1c.shp'))
+    pd.DataFrame(level00.drop('geometry', axis=1)).to_hdf(os.path.join(hydrobasins, 'hybas_na_v1c.h5'), 'level00')
+
+
+def run_point(rootpath, point, **kwargs):
+    """Delineate one point, returning total seconds, its trace, and the mode used"""
+    trace = Trace()
+    info = {}
+    start = time()
+    delineate(rootpath=rootpath, point=point, flavor='geojson', trace=trace, info=info, **kwargs)
+    return time() - start, trace, info.get('mode')
+
+
+def benchmark(rootpath, points, repeat=3, **kwargs):
+    """
+    Run every point repeat times. The first run of each point is reported as cold, the fastest of the rest as warm.
+    """
+    results = []
+    for name, lat, lng in points:
+        runs = []
+        error = None
+        for i in range(repeat):
+            try:
+                runs.append(run_point(rootpath, (lng, lat), **kwargs))
+            except Exception as ex:
+                error = '{}: {}'.format(type(ex).__name__, ex)
+                break
+        result = OrderedDict([('name', name), ('lat', lat), ('lng', lng)])
+        if runs:
+            cold = runs[0]
+            warm = min(runs[1:] or runs, key=lambda run: run[0])
+            result['mode'] = cold[2]
+            result['cold'] = cold[0]
+            result['warm'] = warm[0]
+            result['stages'] = OrderedDict((stage, warm[1].timings.get(stage, 0.0)) for stage in STAGES)
+            result['counts'] = warm[1].counts
+        if error:
+            result['error'] = error
+        results.append(result)
+    return results
+
+
+def count_parts(geometry):
+    return len(getattr(geometry, 'geoms', [geometry]))
+
+
+def compare_merges(rootpath, points):
+    """
+    Delineate every point with both merge methods, as OrderedDicts of the area and number of parts of each result,
+    and whether the two agree
+    """
+    comparisons = []
+    for name, lat, lng in points:
+        comparison = OrderedDict([('name', name)])
+        for merge in ['vector', 'raster']:
+            geometry = delineate(rootpath=rootpath, point=(lng, lat), flavor='shape', merge=merge)
+            comparison[merge] = OrderedDict([('area', geometry.area), ('parts', count_parts(geometry))])
+        vector, raster = comparison['vector'], comparison['raster']
+        comparison['agree'] = vector['parts'] == raster['parts'] and \
+            abs(raster['area'] - vector['area']) <= AREA_TOLERANCE * vector['area']
+        comparisons.append(comparison)
+    return comparisons
+
+
+def report(results):
+    abbreviations = ['regions', 'basins', 'mode', 'search', 'mask', 'trace', 'polygon', 'rmerge', 'union', 'serial']
+    header = '{:<45} {:<12} {:>8} {:>8} '.format('point', 'mode', 'cold', 'warm')
+    print(header + ' '.join('{:>8}'.format(a) for a in abbreviations))
+    for result in results:
+        if 'stages' not in result:
+            print('{:<45} {}'.format(result['name'][:45], result.get('error')))
+            continue
+        line = '{:<45} {:<12} {:>8.3f} {:>8.3f} '.format(result['name'][:45], result['mode'] or '', result['cold'],
+                                                         result['warm'])
+        print(line + ' '.join('{:>8.3f}'.format(t) for t in result['stages'].values()))
+
+
+def main(path, synthetic, repeat, output, merges):
+    if synthetic:
+        if not path:
+            path = tempfile.mkdtemp(prefix='cuencas-fixture-')
+        if not os.path.exists(os.path.join(path, 'hydrosheds', 'na_dir_15s.bil')):
+            print('Writing synthetic fixture to {}'.format(path))
+            make_fixture(path)
+        points = fixture_points()
+    else:
+        points = POINTS
+
+    results = OrderedDict()
+    for merge in merges:
+        print('\nmerge={}'.format(merge))
+        results[merge] = benchmark(path, points, repeat=repeat, merge=merge)
+        report(results[merge])
+
+    disagree = []
+    if 'vector' in merges and 'raster' in merges:
+        print('\nvector vs raster merge')
+        results['comparison'] = compare_merges(path, points)
+        for comparison in results['comparison']:
+            vector, raster = comparison['vector'], comparison['raster']
+            print('{:<45} area {:.6f} vs {:.6f}, parts {} vs {}{}'.format(
+                comparison['name'][:45], vector['area'], raster['area'], vector['parts'], raster['parts'],
+                '' if comparison['agree'] else '  DISAGREE'))
+            if not comparison['agree']:
+                disagree.append(comparison['name'])
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if disagree:
+        raise SystemExit('Merge methods disagree for: {}'.format(', '.join(disagree)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time delineate() over a fixed set of points, stage by stage')
+    parser.add_argument('-p', '--path', default=None,
+                        help='''Data path; defaults to ./data, or a temporary directory with --synthetic''')
+    parser.add_argument('-s', '--synthetic', action='store_true',
+                        help='''Use (and if needed, generate) a small synthetic data set instead of the real one''')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='''Runs per point''')
+    parser.add_argument('-o', '--output', help='''Also write the results as JSON to this file''')
+    parser.add_argument('-m', '--merge', default='vector,raster',
+                        help='''Comma-separated hybrid merge methods to compare, of vector and raster''')
+    args = parser.parse_args()
+
+    main(args.path or (None if args.synthetic else './data'), args.synthetic, args.repeat, args.output,
+         args.merge.split(','))
@@ -1,36 +1,129 @@
 #!/usr/bin/env python3
-import geopandas as gpd
+import gc
 import os
+from time import time
 
 from osgeo import gdal
 from shapely.ops import cascaded_union
-from shapely.geometry import mapping, JOIN_STYLE
+from shapely.geometry import JOIN_STYLE
 
 from .basin_search import delineate_from_basins
-from .grid_search import delineate_missing_from_grid
-from .utils import get_grid_region, get_region01, get_delineation_mode
+from .cost import estimate_cost, preload_estimates, upstream_cell_count
+from . import formats
+from . import datasets, rasters
+from .grid_search import delineate_from_upstream, delineate_missing_from_grid, merge_in_raster
+from .profiling import Trace
+from .rasters import open_raster
+from .region_lookup import lookup_regions, load_region_lookup
+from .tiled_trace import delineate_bounded, needs_bounded_trace, window_cells
+from .upstream_index import load_upstream_index
+from .utils import get_grid_region, get_region01, get_delineation_mode, lonlat2xy, count_vertices, region01_candidates
+
+
+def resolve_regions(rootpath, point, cell_size=15):
+    """HydroSHEDS grid region and HydroBASINS region of a point, as (grid_region, region01)"""
+    grid_region, region01 = lookup_regions(rootpath, point, cell_size)
+    if grid_region is None:
+        dirpath = os.path.join(rootpath, 'hydrosheds', '{}_dir_{}s.bil')
+        grid_region = get_grid_region(point, dirpath, cell_size=cell_size)
+    if region01 is None:
+        region01 = get_region01(rootpath, point)
+    return grid_region, region01
+
+
+def guess_region01(rootpath, point, cell_size=15):
+    """
+    The HydroBASINS region of a point without opening any HydroSHEDS or HydroBASINS data: from the region lookup if it
+    has been built, otherwise the most likely region for its location. Used to route requests to workers.
+    """
+    grid_region, region01 = lookup_regions(rootpath, point, cell_size)
+    return region01 or region01_candidates(point)[0]
+
+
+def locate_pour_cell(rootpath, point, cell_size=15, regions=None):
+    """
+    The flow direction grid cell a point drains from, as (grid_region, region01, x, y).
+
+    :param regions: (grid_region, region01), if already known
+    """
+    grid_region, region01 = regions or resolve_regions(rootpath, point, cell_size)
+    dirpath = os.path.join(rootpath, 'hydrosheds', '{}_dir_{}s.bil')
+    gt = open_raster(dirpath, grid_region, cell_size).GetGeoTransform()
+    x, y = lonlat2xy(point[0], point[1], gt)
+    return grid_region, region01, x, y
+
+
+def warm_start(rootpath, regions, cell_size=15):
+    """
+    Load everything delineate() reads on every call for the given regions, so that processes forked afterwards, e.g.,
+    Celery's prefork children, share it copy-on-write instead of each loading their own. Returns seconds taken.
+
+    Loaded objects are then moved out of the garbage collector's reach where Python allows (gc.freeze, 3.7+), so
+    that collections in the children do not touch, and so copy, the shared pages.
+    """
+    start = time()
+    datasets.preload(rootpath, regions)
+    load_region_lookup(rootpath, cell_size)
+    for region in regions:
+        bilpath = os.path.join(rootpath, 'hydrosheds', '{}_dir_{}s.bil'.format(region, cell_size))
+        if os.path.exists(bilpath):
+            load_upstream_index(bilpath)
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    return time() - start
+
+
+def render(feature, feature_type='Feature'):
+    """Return a GeoJSON feature as is, or wrapped in a FeatureCollection"""
+    if feature_type == 'Feature':
+        return feature
+    else:
+        return {
+            'type': 'FeatureCollection',
+            'features': [feature],
+            'properties': {}
+        }
 
 
 def delineate(rootpath=None, point=None, name=None, max_level=7, cell_size=15, omit_sinks=True, feature_type='Feature',
-              flavor='geojson', mode='traditional'):
-    """Core delineation routine. Point should be as in GeoJSON: [lng, lat]"""
+              flavor='geojson', mode='traditional', grid_region=None, region01=None, info=None, trace=None,
+              grid_tolerance=None, precision=None, tolerance=None, max_vertices=None, merge='vector', upstream=None):
+    """
+    Core delineation routine. Point should be as in GeoJSON: [lng, lat]
+
+    flavor is 'geojson', 'topojson' or 'wkb' (see formats.encode), or anything else for the shapely geometry. The
+    traced grid part is simplified by grid_tolerance degrees, by default one cell, and the whole result by tolerance
+    and max_vertices. GeoJSON coordinates are rounded to precision decimals.
+
+    In hybrid mode, merge='vector' unions the HydroBASINS and grid parts as polygons and cleans up slivers with a
+    buffer, while merge='raster' burns both onto one grid and polygonizes it once, simplifying it by grid_tolerance.
+
+    In traditional mode, upstream may give catchments already delineated on the same grid, as a dict of their (x, y)
+    outlet cells to functions returning their footprints. Only the area between the point and those it reaches is
+    traced and polygonized, and the known catchments are unioned with it.
+
+    The regions may be given if already known, e.g., from resolve_regions. If info is a dict, the delineation mode
+    used is added to it, and in traditional mode, the footprint: the unsimplified polygon of the grid cells, which
+    follows their edges exactly and so can be reused as part of upstream. If trace is a profiling.Trace, the time
+    spent in each stage, cells visited, raster reads, polygons unioned, output vertices and cache hits are added to it.
+    """
 
     # STEP 1: Intialization
 
-    # register the bil driver
-    bildriver = gdal.GetDriverByName('EHdr')
-    bildriver.Register()
+    trace = trace or Trace()
+    pool_before = rasters.pool.stats()
+    datasets_before = datasets.stats()
 
-    # register the geotiff driver
+    # drivers are registered once per process by the raster pool
     geodriver = gdal.GetDriverByName('GTiff')
-    geodriver.Register()
 
     dirpath = os.path.join(rootpath, 'hydrosheds', '{}_dir_{}s.bil')
     accpath = os.path.join(rootpath, 'hydrosheds', '{}_acc_{}s.bil')
 
-    grid_region = get_grid_region(point, dirpath, cell_size=cell_size)
-    PATH = os.path.join(rootpath, 'hydrobasins', 'hybas_{r}_lev{l:02}_v1c.{e}')
-    region01 = get_region01(PATH, point)
+    with trace.stage('regions'):
+        if grid_region is None or region01 is None:
+            grid_region, region01 = resolve_regions(rootpath, point, cell_size)
 
     lng, lat = point
 
@@ -38,70 +131,110 @@ def delineate(rootpath=None, point=None, name=None, max_level=7, cell_size=15, o
     feature0x = None
     remnant = None
     for i, level in enumerate(range(max_level, 0, -1)):
-        path = PATH.format(r=region01, l=level, e='shp')
-        basins = gpd.read_file(path)
+        with trace.stage('basins'):
+            basins = datasets.get_basins(rootpath, region01, level)
         if i == 0:
-            feature0x = basins.cx[lng - 0.001:lng + 0.001, lat - 0.001:lat + 0.001]
+            with trace.stage('basins'):
+                feature0x = datasets.locate_basins(rootpath, region01, level, point, tolerance=0.001)
 
             props0x = feature0x.iloc[0]
             remnant = props0x['geometry']
 
-            mode = get_delineation_mode(accpath, point, basins, props0x, grid_region, cell_size)
+            with trace.stage('mode'):
+                max_acc = datasets.get_max_acc(rootpath, region01, level)
+                mode = get_delineation_mode(accpath, point, basins, props0x, grid_region, cell_size, max_acc=max_acc)
 
             if mode == 'traditional':
                 break
 
         hydrobasins[level] = basins
 
+    if info is not None:
+        info['mode'] = mode
+
     # STEP 3: Delineate from HydroBASINS
     if mode == 'hybrid':
-        hydropath = PATH
-        h5path = os.path.join(rootpath, 'hydrobasins', 'hybas_{}_v1c.h5'.format(region01))
-        main = delineate_from_basins(hydropath, h5path, point, hydrobasins, region01, feature0x, max_level, omit_sinks)
+        with trace.stage('basin_search'):
+            main = delineate_from_basins(rootpath, point, hydrobasins, region01, feature0x, max_level, omit_sinks,
+                                         trace=trace)
     else:
         main = None
         remnant = None
 
     # STEP 4: Delineate from HydroSHEDS flow direction grid
 
-    remaining = delineate_missing_from_grid(point, grid_region, dirpath, geodriver, cell_size, mask=remnant)
+    if grid_tolerance is None:
+        grid_tolerance = cell_size / 60 / 60
 
-    basin = main
-    if remaining:
-        simplified = remaining.simplify(15/60/60)
-        # simplified = remaining
+    # grids too large to trace or burn in memory are handled tile by tile within CUENCAS_TRACE_MEMORY_MB: a whole
+    # catchment in traditional mode, less any saved catchments reused, and in hybrid mode the pour basin, or
+    # with merge='raster', the window covering it and the HydroBASINS part
+    if mode == 'traditional':
+        cells = upstream_cell_count(rootpath, point, grid_region, cell_size)
+    elif merge == 'raster' and main:
+        cells = window_cells([main, remnant], cell_size)
     else:
-        simplified = None
-    if main and simplified:
-        basin = cascaded_union([main, simplified])
-    elif simplified:
-        basin = simplified
-    if simplified:
-        # we need to cleanup slivers created on join
-        # method from: https://gis.stackexchange.com/questions/120286/removing-small-polygons-gaps-in-a-shapely-polygon
-        eps = 0.005
-        basin = basin.buffer(eps, 1, join_style=JOIN_STYLE.mitre).buffer(-eps, 1, join_style=JOIN_STYLE.mitre)
-
-
-    if flavor == 'geojson':
-        # coordinates = [mapping(basin.exterior)['coordinates']]
-        coordinates = mapping(basin)['coordinates']
-        feature = {
-            'type': 'Feature',
-            'geometry': {
-                'type': 'Polygon',
-                'coordinates': coordinates
-            },
-            'properties': {}
-        }
-        if feature_type == 'Feature':
-            return feature
+        cells = window_cells([remnant], cell_size)
+    bounded = needs_bounded_trace(cells)
+
+    if merge == 'raster' and main:
+        if bounded:
+            basin = delineate_bounded(point, grid_region, dirpath, cell_size, mask=remnant, main=main, trace=trace)
+        else:
+            basin = merge_in_raster(main, point, grid_region, dirpath, cell_size, mask=remnant, trace=trace)
+        with trace.stage('union'):
+            basin = basin.simplify(grid_tolerance)
+
+    elif mode == 'traditional' and upstream:
+        if bounded:
+            basin = delineate_bounded(point, grid_region, dirpath, cell_size, upstream=upstream, trace=trace)
+        else:
+            basin, reused = delineate_from_upstream(point, grid_region, dirpath, cell_size, upstream, trace=trace)
+            trace.count('catchments_reused', reused)
+        if info is not None:
+            info['footprint'] = basin
+        with trace.stage('union'):
+            basin = basin.simplify(grid_tolerance)
+
+    else:
+        if bounded:
+            remaining = delineate_bounded(point, grid_region, dirpath, cell_size, mask=remnant, trace=trace)
         else:
-            return {
-                'type': 'FeatureCollection',
-                'features': [feature],
-                'properties': {}
-            }
+            remaining = delineate_missing_from_grid(point, grid_region, dirpath, geodriver, cell_size, mask=remnant,
+                                                    trace=trace)
+        if info is not None and mode == 'traditional':
+            info['footprint'] = remaining
+
+        with trace.stage('union'):
+            basin = main
+            if remaining:
+                simplified = remaining.simplify(grid_tolerance)
+            else:
+                simplified = None
+            if main and simplified:
+                basin = cascaded_union([main, simplified])
+            elif simplified:
+                basin = simplified
+            if simplified:
+                # we need to cleanup slivers created on join
+                # method from:
+                # https://gis.stackexchange.com/questions/120286/removing-small-polygons-gaps-in-a-shapely-polygon
+                eps = 0.005
+                basin = basin.buffer(eps, 1, join_style=JOIN_STYLE.mitre).buffer(-eps, 1, join_style=JOIN_STYLE.mitre)
+
+    trace.count('vertices', count_vertices(basin))
+    for cache, before, after in [('raster_pool', pool_before, rasters.pool.stats()),
+                                 ('dataset_cache', datasets_before, datasets.stats())]:
+        trace.count('{}_hits'.format(cache), after['hits'] - before['hits'])
+        trace.count('{}_misses'.format(cache), after['misses'] - before['misses'])
+
+    if flavor in formats.FORMATS:
+        with trace.stage('serialize'):
+            feature = formats.encode(basin, flavor, precision=precision, tolerance=tolerance,
+                                     max_vertices=max_vertices)
+        if flavor == 'geojson':
+            return render(feature, feature_type)
+        return feature
 
     else:
-        return basin
+        return formats.simplify(basin, tolerance=tolerance, max_vertices=max_vertices)
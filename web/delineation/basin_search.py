@@ -1,9 +1,13 @@
-import fiona
-import pandas as pd
+import numpy as np
 from shapely.ops import cascaded_union
 from matplotlib.path import Path
 from osgeo import ogr
 
+from . import datasets
+from .profiling import Trace
+from .topology import BasinTopology
+from .union_cache import get_union_cache
+
 
 def point_in_polygon(polygon, point):
     if type(polygon[0][0]) == float:
@@ -21,13 +25,11 @@ def point_in_feature(feature, point):
     return point_in_polygon(polygon, point)
 
 
-def get_feature00(path, point, PFAF_X, PFAF_X_ID):
-    with fiona.open(path) as shapes:
-        for feature in shapes:
-            if feature['properties'][PFAF_X] != PFAF_X_ID:
-                continue
-            if point_in_feature(feature, point):
-                return feature
+def get_feature00(rootpath, region, point, PFAF_X, PFAF_X_ID):
+    candidates = datasets.locate_basins(rootpath, region, 0, point)
+    candidates = candidates.loc[candidates[PFAF_X] == PFAF_X_ID]
+    if not candidates.empty:
+        return candidates.iloc[0]
 
 
 def get_feature00_test(path, point, PFAF_X, PFAF_X_ID):
@@ -48,12 +50,12 @@ def get_feature00_test(path, point, PFAF_X, PFAF_X_ID):
     #
 
 
-def get_basins(df00, hydrobasins, props00, max_level, omit_sinks=True):
+def search_basins(df00, hydrobasins, props00, max_level, omit_sinks=True, topologies=None):
+    """Yield (level, HYBAS_ID of the basin searched upstream of, contributing basins) for each level with results"""
     # NOTE: This only works for subwats in the main stem. To search side subwats,
     # an additional search of the original df00 needs to be performed to omit
     # higher level subwats that don't contribute to the smallest subat
 
-    all_basins = []
     df00x = df00.iloc[:]
     for level in range(2, max_level + 1):
         PFAFp = 'PFAF_{}'.format(level - 1)
@@ -65,86 +67,77 @@ def get_basins(df00, hydrobasins, props00, max_level, omit_sinks=True):
         PFAFlist = list(set(df00x[PFAF].tolist()))  # list of current level PFAFs
 
         basins = hydrobasins[level]
-        basins = basins.loc[basins['PFAF_ID'].isin(PFAFlist)]  # initial filter to current PFAF
+        candidates = basins['PFAF_ID'].isin(PFAFlist).values  # initial filter to current PFAF
 
         # filter out lower basins; this basically follows a drop of water downslope
         # if a subbasin contributes to the current basin, then include it (and filter it out from future searchs)
-        this_basin = basins.loc[basins['PFAF_ID'] == props00[PFAF]]
-        if this_basin.empty:
+        this_basin = np.flatnonzero(candidates & (basins['PFAF_ID'] == props00[PFAF]).values)
+        if not len(this_basin):
             continue
-        this_basin_id = this_basin.iloc[0]['HYBAS_ID']
-        to_include = []
-        PFAF_IDs = []  # for filtering df00 so we don't query this region next time
-        for i, subbasin in basins.iterrows():
-            if omit_sinks:
-                next_down = subbasin['NEXT_DOWN']
-            else:
-                next_down = subbasin['NEXT_SINK']
-            next_sink = subbasin['NEXT_SINK']
-            main_basin = subbasin['MAIN_BAS']
-            if omit_sinks and main_basin != next_sink:
-                PFAF_IDs.append(subbasin['PFAF_ID'])
-                continue
-            subbasin_chain = [subbasin['HYBAS_ID']]
-            PFAF_chain = [subbasin['PFAF_ID']]
-            if subbasin['HYBAS_ID'] in to_include:
-                continue
-            while next_down:
-                if next_down == this_basin_id or next_down in to_include:
-                    to_include.extend(subbasin_chain)
-                    PFAF_IDs.extend(PFAF_chain)
-                    break
-
-                down_basin = basins.loc[basins['HYBAS_ID'] == next_down]
-                if not down_basin.empty:
-                    down_basin_props = down_basin.iloc[0]
-                    subbasin_chain.append(down_basin_props['HYBAS_ID'])
-                    PFAF_chain.append(down_basin_props['PFAF_ID'])
-                    if omit_sinks:
-                        next_down = down_basin_props['NEXT_DOWN']
-                    else:
-                        next_down = down_basin_props['NEXT_SINK']
-                else:
-                    break  # it's unclear how we could get here
-        to_include_set = set(to_include)
-        basins = basins.loc[basins['HYBAS_ID'].isin(to_include_set)]
+        topology = topologies[level] if topologies else BasinTopology(basins)
+        included, searched = topology.contributing(this_basin[0], candidates, omit_sinks)
+        PFAF_IDs = basins['PFAF_ID'].values[searched]  # for filtering df00 so we don't query this region next time
+
+        basins = basins.loc[included]
         # basins['OA_ID'] = OA_ID
         # basins['NAME'] = OA_NAME
+        df00x = df00x.loc[~df00x[PFAF].isin(PFAF_IDs)]  # filter out this region
+
         if not basins.empty:
-            all_basins.append(basins)
+            yield level, topology.ids[this_basin[0]], basins
 
-        df00x = df00x.loc[~df00x[PFAF].isin(PFAF_IDs)]  # filter out this region
 
-    return all_basins
+def get_basins(df00, hydrobasins, props00, max_level, omit_sinks=True, topologies=None):
+    return [basins for level, this_basin_id, basins in
+            search_basins(df00, hydrobasins, props00, max_level, omit_sinks, topologies)]
 
 
-def delineate_from_basins(hydropath, h5path, point, hydrobasins, region01, feature0x, max_level=7, omit_sinks=True):
-    path01 = hydropath.format(r=region01, l=0, e='shp')
+def delineate_from_basins(rootpath, point, hydrobasins, region01, feature0x, max_level=7, omit_sinks=True,
+                          trace=None):
+    trace = trace or Trace()
     PFAF_X = 'PFAF_{}'.format(max_level)
     PFAF_X_ID = feature0x.iloc[0]['PFAF_ID']
 
-    feature00 = get_feature00(path01, point, PFAF_X, PFAF_X_ID)
+    # the result only depends on the pour basin, so it may already have been computed
+    cache = get_union_cache(rootpath)
+    key = ('upstream', region01, max_level, feature0x.iloc[0]['HYBAS_ID'], omit_sinks)
+    basin = cache.get(key)
+    if basin is not None:
+        trace.count('union_cache_hits')
+        return basin
+    trace.count('union_cache_misses')
+
+    feature00 = get_feature00(rootpath, region01, point, PFAF_X, PFAF_X_ID)
 
     if feature00 is None:
-        return None, None
+        return None
 
-    props00 = feature00['properties']
+    props00 = feature00
 
     # load the level00 lookup table
-    df00 = pd.read_hdf(h5path, 'level00')
+    df00 = datasets.get_level00(rootpath, region01)
 
     df00x = df00.loc[df00['MAIN_BAS'] == props00['MAIN_BAS']]
 
-    all_basins = get_basins(df00x, hydrobasins, props00, max_level, omit_sinks)
+    topologies = {level: datasets.get_topology(rootpath, region01, level) for level in hydrobasins}
 
-    basin = None
+    # each level's union is shared by every pour basin downstream of the same basin at that level
     polygons = []
-
-    if all_basins:
-        for basins in all_basins:
-            polygons.extend(row['geometry'] for i, row in basins.iterrows())
+    for level, this_basin_id, basins in search_basins(df00x, hydrobasins, props00, max_level, omit_sinks, topologies):
+        level_key = ('level', region01, level, this_basin_id, omit_sinks)
+        polygon = cache.get(level_key)
+        if polygon is None:
+            trace.count('union_cache_misses')
+            trace.count('polygons_unioned', len(basins))
+            polygon = cascaded_union(list(basins['geometry']))
+            cache.put(level_key, polygon)
+        else:
+            trace.count('union_cache_hits')
+        polygons.append(polygon)
 
     if polygons:
         basin = cascaded_union(polygons)
+        trace.count('polygons_unioned', len(polygons))
+        cache.put(key, basin)
 
     return basin
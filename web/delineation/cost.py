@@ -0,0 +1,75 @@
+import os
+
+from . import datasets
+from .rasters import open_raster
+from .union_cache import get_union_cache
+from .utils import get_delineation_mode, lonlat2xy
+
+# rough costs of a delineation with warm caches, for deciding whether to answer a request inline or queue it
+BASE_SECONDS = float(os.environ.get('CUENCAS_COST_BASE_SECONDS', 0.05))
+SECONDS_PER_CELL = float(os.environ.get('CUENCAS_COST_SECONDS_PER_CELL', 2e-6))
+
+# dissolving the HydroBASINS part of a hybrid delineation, when it is not in the union cache
+UNION_SECONDS = float(os.environ.get('CUENCAS_COST_UNION_SECONDS', 5))
+
+
+def upstream_cell_count(rootpath, point, grid_region, cell_size=15):
+    """Number of grid cells draining to a point, including its own, from flow accumulation at its pour cell"""
+    accpath = os.path.join(rootpath, 'hydrosheds', '{}_acc_{}s.bil')
+    bil = open_raster(accpath, grid_region, cell_size)
+    x, y = lonlat2xy(point[0], point[1], bil.GetGeoTransform())
+    return max(int(bil.GetRasterBand(1).ReadAsArray(x, y, 1, 1)[0][0]), 0) + 1
+
+
+def preload_estimates(rootpath, regions, max_level=7):
+    """
+    Load, and pin, the HydroBASINS layers estimate_cost() reads for each region, and those a hybrid delineation reads
+    when its union is cached, e.g. at web app startup
+    """
+    with datasets.pin():
+        for region in regions:
+            datasets.get_basin_index(rootpath, region, max_level)
+            datasets.get_max_acc(rootpath, region, max_level)
+            for level in range(1, max_level):
+                datasets.get_basins(rootpath, region, level)
+
+
+def estimate_cost(rootpath, point, grid_region, region01, cell_size=15, max_level=7, omit_sinks=True,
+                  loaded_only=False):
+    """
+    Rough seconds to delineate a point, as (seconds, mode, cells).
+
+    cells is the number of grid cells to trace: every cell upstream of the pour cell, from flow accumulation there, in
+    traditional mode, and at most those of the pour basin in hybrid mode.
+
+    With loaded_only, returns None rather than load any HydroBASINS layer, which takes far longer than the estimate
+    (and, in hybrid mode, than the delineation itself), or read accumulation within the upstream basins when there is
+    no precomputed table.
+    """
+    if loaded_only and not datasets.loaded(rootpath, region01, max_level):
+        return None
+
+    accpath = os.path.join(rootpath, 'hydrosheds', '{}_acc_{}s.bil')
+    gt = open_raster(accpath, grid_region, cell_size).GetGeoTransform()
+    cells = upstream_cell_count(rootpath, point, grid_region, cell_size)
+
+    # the same choice of mode as delineate()
+    basins = datasets.get_basins(rootpath, region01, max_level)
+    props0x = datasets.locate_basins(rootpath, region01, max_level, point, tolerance=0.001).iloc[0]
+    max_acc = datasets.get_max_acc(rootpath, region01, max_level)
+    if loaded_only and max_acc is None:
+        return None
+    mode = get_delineation_mode(accpath, point, basins, props0x, grid_region, cell_size, max_acc=max_acc)
+
+    seconds = BASE_SECONDS
+    if mode == 'hybrid':
+        if loaded_only and not all(datasets.loaded(rootpath, region01, level, ['basins'])
+                                   for level in range(1, max_level)):
+            return None
+        cells = min(cells, int(props0x['geometry'].area / (gt[1] * -gt[5])) + 1)
+        key = ('upstream', region01, max_level, props0x['HYBAS_ID'], omit_sinks)
+        if not get_union_cache(rootpath).contains(key):
+            seconds += UNION_SECONDS
+    seconds += cells * SECONDS_PER_CELL
+
+    return seconds, mode, cells
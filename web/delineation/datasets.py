@@ -0,0 +1,229 @@
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import geopandas as gpd
+import pandas as pd
+
+from .spatial_index import BasinIndex
+from .topology import BasinTopology
+
+# estimated memory of the HydroBASINS layers and tables kept per process; one region's layers are a few dozen entries
+# and roughly the size of its shapefiles
+DATASETS_MB = int(os.environ.get('CUENCAS_DATASETS_MB', 4096))
+
+BASIN_COLUMNS = ['HYBAS_ID', 'NEXT_DOWN', 'NEXT_SINK', 'MAIN_BAS', 'PFAF_ID', 'UP_AREA', 'geometry']
+
+
+def basins_path(rootpath, region, level, ext='shp'):
+    return os.path.join(rootpath, 'hydrobasins', 'hybas_{r}_lev{l:02}_v1c.{e}'.format(r=region, l=level, e=ext))
+
+
+def h5_path(rootpath, region):
+    return os.path.join(rootpath, 'hydrobasins', 'hybas_{}_v1c.h5'.format(region))
+
+
+class LRUCache(object):
+    """
+    A least-recently-used cache of loaded datasets, bounded by number of entries and, for entries loaded with a sizeof
+    function, by their estimated bytes. The most recently loaded entry is always kept, and pinned entries are never
+    evicted, though they count towards the bounds.
+    """
+
+    def __init__(self, maxsize=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.pinned = set()
+        self.pinning = False
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def pin(self):
+        """Pin every entry used within the block, whether already loaded or not"""
+        self.pinning = True
+        try:
+            yield
+        finally:
+            self.pinning = False
+
+    def get(self, key, load, sizeof=None):
+        if self.pinning:
+            self.pinned.add(key)
+        if key in self.items:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+        self.misses += 1
+        value = load()
+        self.items[key] = value
+        self.sizes[key] = sizeof(value) if sizeof else 0
+        self.nbytes += self.sizes[key]
+        self.evict()
+        return value
+
+    def full(self):
+        return (self.maxsize and len(self.items) > self.maxsize) or (self.max_bytes and self.nbytes > self.max_bytes)
+
+    def evict(self):
+        for key in [k for k in list(self.items)[:-1] if k not in self.pinned]:
+            if not self.full():
+                break
+            self.discard(key)
+
+    def resize(self, key, nbytes):
+        """Update the estimated bytes of an entry that has grown, e.g., by an index built on it"""
+        self.nbytes += nbytes - self.sizes.get(key, 0)
+        self.sizes[key] = nbytes
+        self.evict()
+
+    def discard(self, key):
+        self.items.pop(key, None)
+        self.nbytes -= self.sizes.pop(key, 0)
+
+    def clear(self):
+        self.items.clear()
+        self.sizes.clear()
+        self.pinned.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'open': len(self.items), 'mb': self.nbytes / 1024 / 1024}
+
+
+_datasets = LRUCache(max_bytes=DATASETS_MB * 1024 * 1024)
+
+
+def stats():
+    """Hits and misses of the loaded dataset cache in this process"""
+    return _datasets.stats()
+
+
+def _frame_bytes(df):
+    """Memory of a DataFrame's columns, counting each geometry as only a pointer"""
+    return int(df.memory_usage(index=True).sum())
+
+
+def _keep_columns(df, level):
+    if level == 0:
+        # level 0 is only used for its Pfafstetter codes
+        columns = [c for c in df.columns if c in ('HYBAS_ID', 'MAIN_BAS', 'geometry') or c.startswith('PFAF_')]
+    else:
+        columns = [c for c in BASIN_COLUMNS if c in df.columns]
+    return df[columns]
+
+
+class Layer(object):
+    """
+    A HydroBASINS layer and, once built, its spatial index, cached as one entry: the index holds every geometry of the
+    layer, so dropping either one alone would free almost nothing
+    """
+
+    def __init__(self, basins, path):
+        self.basins = basins
+        self.path = path
+        self.index = None
+
+    @property
+    def nbytes(self):
+        # the geometries take about as much memory as the shapefile's coordinates, and prepared geometries index their
+        # edges once used, taking about as much again
+        geometries = os.path.getsize(self.path)
+        return _frame_bytes(self.basins) + geometries * (2 if self.index is not None else 1)
+
+
+def _layer(rootpath, region, level):
+    path = basins_path(rootpath, region, level)
+
+    def load():
+        return Layer(_keep_columns(gpd.read_file(path), level), path)
+
+    return _datasets.get((rootpath, region, 'basins', level), load, lambda layer: layer.nbytes)
+
+
+def get_basins(rootpath, region, level):
+    """HydroBASINS layer for a region and level, as a GeoDataFrame with only the columns used in delineation"""
+    return _layer(rootpath, region, level).basins
+
+
+def get_basin_index(rootpath, region, level):
+    """Spatial index over the geometries of a HydroBASINS layer, built once and kept with the layer"""
+    layer = _layer(rootpath, region, level)
+    if layer.index is None:
+        layer.index = BasinIndex(layer.basins['geometry'])
+        _datasets.resize((rootpath, region, 'basins', level), layer.nbytes)
+    return layer.index
+
+
+def get_topology(rootpath, region, level):
+    """Drainage graph of a HydroBASINS layer"""
+
+    def load():
+        return BasinTopology(get_basins(rootpath, region, level))
+
+    return _datasets.get((rootpath, region, 'topology', level), load, lambda topology: topology.nbytes)
+
+
+def loaded(rootpath, region, level, kinds=('basins', 'index', 'maxacc')):
+    """
+    Whether the layer of a region and level is in memory, by default with its spatial index and accumulation table
+    """
+    layer = _datasets.items.get((rootpath, region, 'basins', level))
+    if 'index' in kinds and (layer is None or layer.index is None):
+        return False
+    return all((rootpath, region, kind, level) in _datasets.items for kind in kinds if kind != 'index')
+
+
+def locate_basins(rootpath, region, level, point, tolerance=0.0):
+    """The features of a HydroBASINS layer containing point, as a GeoDataFrame"""
+    layer = _layer(rootpath, region, level)
+    positions = get_basin_index(rootpath, region, level).locate(point, tolerance=tolerance)
+    return layer.basins.iloc[positions]
+
+
+def get_level00(rootpath, region):
+    """Level 0 attribute table, as saved by init.py"""
+
+    def load():
+        df00 = pd.read_hdf(h5_path(rootpath, region), 'level00')
+        return df00[[c for c in df00.columns if c == 'MAIN_BAS' or c.startswith('PFAF_')]]
+
+    return _datasets.get((rootpath, region, 'level00'), load, _frame_bytes)
+
+
+def get_max_acc(rootpath, region, level):
+    """Precomputed maximum flow accumulation per basin, as saved by preprocess.py, or None if not available"""
+
+    def load():
+        try:
+            return pd.read_hdf(h5_path(rootpath, region), 'maxacc{:02}'.format(level))
+        except (KeyError, IOError):
+            return None
+
+    return _datasets.get((rootpath, region, 'maxacc', level), load, lambda df: 0 if df is None else _frame_bytes(df))
+
+
+def pin():
+    """Pin the datasets loaded or used within the block, as preload does"""
+    return _datasets.pin()
+
+
+def preload(rootpath, regions, max_level=7):
+    """
+    Load the layers used by delineate() for each region, e.g. at worker startup, and pin them so that layers loaded
+    later for other regions never evict them
+    """
+    with _datasets.pin():
+        for region in regions:
+            for level in range(max_level + 1):
+                get_basin_index(rootpath, region, level)
+                if level:
+                    get_topology(rootpath, region, level)
+                    get_max_acc(rootpath, region, level)
+            get_level00(rootpath, region)
+    if _datasets.max_bytes and _datasets.nbytes > _datasets.max_bytes:
+        print('WARNING: preloaded regions {} take an estimated {:.0f} MB, more than CUENCAS_DATASETS_MB'.format(
+            regions, _datasets.nbytes / 1024 / 1024))
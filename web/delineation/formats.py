@@ -0,0 +1,127 @@
+import os
+from collections import OrderedDict
+
+from shapely import wkb
+from shapely.geometry import mapping, shape
+
+from .utils import count_vertices
+
+FORMATS = ['geojson', 'topojson', 'wkb']
+
+# pre-simplified resolutions computed once per delineation, by vertex budget; 'full' is the geometry as delineated
+RESOLUTIONS = OrderedDict([
+    ('preview', int(os.environ.get('CUENCAS_PREVIEW_VERTICES', 500))),
+    ('medium', int(os.environ.get('CUENCAS_MEDIUM_VERTICES', 5000))),
+])
+
+# TopoJSON coordinates are quantized to a grid of this many positions across the bounding box
+QUANTIZATION = 100000
+
+
+def simplify(geometry, tolerance=None, max_vertices=None):
+    """
+    Simplify a geometry by a tolerance in degrees, and then, if it still has more than max_vertices vertices, by
+    doubling tolerances until it fits. Rings cannot lose their last vertices, so very fragmented geometries may not
+    fit.
+    """
+    if tolerance:
+        geometry = geometry.simplify(tolerance, preserve_topology=True)
+    if not max_vertices or geometry.is_empty or count_vertices(geometry) <= max_vertices:
+        return geometry
+    minx, miny, maxx, maxy = geometry.bounds
+    step = max(tolerance or 0, max(maxx - minx, maxy - miny) / 10000)
+    for i in range(20):
+        simplified = geometry.simplify(step, preserve_topology=True)
+        if count_vertices(simplified) <= max_vertices:
+            break
+        step *= 2
+    return simplified
+
+
+def resolutions(geometry):
+    """The pre-simplified versions of a geometry, by resolution name, for those it has too many vertices for"""
+    simplified = OrderedDict()
+    for name, max_vertices in RESOLUTIONS.items():
+        if count_vertices(geometry) > max_vertices:
+            simplified[name] = simplify(geometry, max_vertices=max_vertices)
+    return simplified
+
+
+def _round(coordinates, precision):
+    if isinstance(coordinates[0], (int, float)):
+        return [round(c, precision) for c in coordinates]
+    return [_round(c, precision) for c in coordinates]
+
+
+def to_geojson(geometry, precision=None):
+    """A GeoJSON geometry, of whatever type the geometry is, with coordinates rounded to precision decimals"""
+    geojson = mapping(geometry)
+    if precision is not None and geojson['coordinates']:
+        return {'type': geojson['type'], 'coordinates': _round(geojson['coordinates'], precision)}
+    return geojson
+
+
+def to_topojson(geometry, properties=None, quantization=QUANTIZATION):
+    """
+    A quantized, delta-encoded TopoJSON topology with the geometry as its one object, 'catchment'. Each ring is its
+    own arc.
+    """
+    geojson = mapping(geometry)
+    if geometry.is_empty:
+        return {'type': 'Topology', 'objects': {'catchment': {'type': None, 'properties': properties or {}}},
+                'arcs': []}
+
+    minx, miny, maxx, maxy = geometry.bounds
+    kx = (maxx - minx) / (quantization - 1) or 1
+    ky = (maxy - miny) / (quantization - 1) or 1
+
+    arcs = []
+
+    def arc(ring):
+        qx0 = qy0 = 0
+        encoded = []
+        for x, y in ring:
+            qx = int(round((x - minx) / kx))
+            qy = int(round((y - miny) / ky))
+            if encoded and qx == qx0 and qy == qy0:
+                continue
+            encoded.append([qx - qx0, qy - qy0])
+            qx0, qy0 = qx, qy
+        arcs.append(encoded)
+        return [len(arcs) - 1]
+
+    if geojson['type'] == 'Polygon':
+        object_arcs = [arc(ring) for ring in geojson['coordinates']]
+    else:
+        object_arcs = [[arc(ring) for ring in polygon] for polygon in geojson['coordinates']]
+
+    return {
+        'type': 'Topology',
+        'bbox': [minx, miny, maxx, maxy],
+        'transform': {'scale': [kx, ky], 'translate': [minx, miny]},
+        'objects': {'catchment': {'type': geojson['type'], 'arcs': object_arcs, 'properties': properties or {}}},
+        'arcs': arcs,
+    }
+
+
+def encode(geometry, flavor='geojson', properties=None, precision=None, tolerance=None, max_vertices=None):
+    """
+    A geometry as a GeoJSON feature, a TopoJSON topology, or {'type': 'WKB', 'wkb': hex, 'properties': ...}
+
+    :param precision: decimals kept in GeoJSON coordinates
+    :param tolerance: simplification tolerance, in degrees
+    :param max_vertices: simplify further until the geometry has at most this many vertices
+    """
+    geometry = simplify(geometry, tolerance=tolerance, max_vertices=max_vertices)
+    properties = properties if properties is not None else {}
+    if flavor == 'topojson':
+        return to_topojson(geometry, properties)
+    elif flavor == 'wkb':
+        return {'type': 'WKB', 'wkb': wkb.dumps(geometry, hex=True), 'properties': properties}
+    else:
+        return {'type': 'Feature', 'geometry': to_geojson(geometry, precision), 'properties': properties}
+
+
+def encode_feature(feature, flavor='geojson', **kwargs):
+    """encode() for a GeoJSON feature, keeping its properties"""
+    return encode(shape(feature['geometry']), flavor, properties=feature.get('properties', {}), **kwargs)
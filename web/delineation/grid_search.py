@@ -1,100 +1,444 @@
-from osgeo import gdal
+from collections import OrderedDict
+
 import numpy as np
-from shapely.geometry import Point, Polygon
-from shapely.ops import cascaded_union
+from shapely.geometry import MultiPolygon, Point, mapping, shape
+from shapely.ops import cascaded_union, transform
+from shapely.prepared import prep
 
 from rasterio import features
 from rasterio.transform import from_origin
 
-from .utils import lonlat2xy, xy2lonlat
+from .profiling import Trace
+from .rasters import open_raster
+from .upstream_index import load_upstream_index, upstream_cells
+from .utils import contributions, lonlat2xy, xy2lonlat
+
+# (row, column) offsets of the eight neighbors, and the D8 code each must have to drain into the center cell
+NEIGHBOR_OFFSETS = np.array([(i - 1, j - 1) for (i, j) in sorted(contributions) if (i, j) != (1, 1)])
+NEIGHBOR_CODES = np.array([contributions[(i, j)] for (i, j) in sorted(contributions) if (i, j) != (1, 1)])
+
+# flow direction grids are read in square tiles of this many cells
+TILE_SIZE = 1024
+
+
+def _group_by_tile(ys, xs, tile_size, ntx):
+    """Yield (ty, tx, selection) for each tile touched by cells (ys, xs)"""
+    tys = ys // tile_size
+    txs = xs // tile_size
+    keys = tys * ntx + txs
+    for key in np.unique(keys):
+        ty, tx = divmod(int(key), ntx)
+        yield ty, tx, keys == key
+
+
+class TiledGrid(object):
+    """
+    Read-on-demand tile cache over a single GDAL raster band. With max_tiles, the least recently used tiles are dropped
+    beyond that many, and read again if needed.
+    """
+
+    def __init__(self, band, tile_size=TILE_SIZE, max_tiles=None):
+        self.band = band
+        self.tile_size = tile_size
+        self.xsize = band.XSize
+        self.ysize = band.YSize
+        self.ntx = -(-self.xsize // tile_size)
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.reads = 0
+
+    def tile(self, ty, tx):
+        key = (ty, tx)
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+        else:
+            x0 = tx * self.tile_size
+            y0 = ty * self.tile_size
+            cols = min(self.tile_size, self.xsize - x0)
+            rows = min(self.tile_size, self.ysize - y0)
+            self.tiles[key] = self.band.ReadAsArray(x0, y0, cols, rows)
+            self.reads += 1
+            while self.max_tiles and len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        return self.tiles[key]
+
+    def values(self, ys, xs):
+        """Gather the values at cells (ys, xs), reading any tiles not yet in memory"""
+        values = np.empty(len(ys), dtype=np.int64)
+        for ty, tx, sel in _group_by_tile(ys, xs, self.tile_size, self.ntx):
+            tile = self.tile(ty, tx)
+            values[sel] = tile[ys[sel] - ty * self.tile_size, xs[sel] - tx * self.tile_size]
+        return values
+
+
+class TiledMask(object):
+    """Sparse boolean raster, allocated one tile at a time"""
+
+    def __init__(self, xsize, ysize, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.ntx = -(-xsize // tile_size)
+        self.tiles = {}
+
+    def tile(self, ty, tx):
+        key = (ty, tx)
+        if key not in self.tiles:
+            self.tiles[key] = np.zeros((self.tile_size, self.tile_size), dtype=bool)
+        return self.tiles[key]
+
+    def get(self, ys, xs):
+        values = np.zeros(len(ys), dtype=bool)
+        for ty, tx, sel in _group_by_tile(ys, xs, self.tile_size, self.ntx):
+            if (ty, tx) in self.tiles:
+                values[sel] = self.tiles[(ty, tx)][ys[sel] - ty * self.tile_size, xs[sel] - tx * self.tile_size]
+        return values
+
+    def set(self, ys, xs):
+        for ty, tx, sel in _group_by_tile(ys, xs, self.tile_size, self.ntx):
+            self.tile(ty, tx)[ys[sel] - ty * self.tile_size, xs[sel] - tx * self.tile_size] = True
+
+
+def trace_levels(grid, x, y, visited, include=None, chunk_size=None):
+    """
+    Breadth-first search upstream of (x, y) over the flow direction grid, yielding the arrays (xs, ys) of cells found
+    at each step, starting with the pour point, and marking them in visited.
+
+    :param visited: a TiledMask, or any object with the same get and set methods
+    :param chunk_size: optional number of frontier cells to expand at a time, to bound temporary arrays
+    """
+
+    visited.set(np.array([y]), np.array([x]))
+    yield np.array([x]), np.array([y])
+    frontier_ys = np.array([y])
+    frontier_xs = np.array([x])
+
+    while len(frontier_ys):
+        step = chunk_size or len(frontier_ys)
+        next_ys = []
+        next_xs = []
+        for i in range(0, len(frontier_ys), step):
+            chunk_ys = frontier_ys[i:i + step]
+            chunk_xs = frontier_xs[i:i + step]
+
+            # all eight neighbors of every frontier cell
+            ys = (chunk_ys[:, None] + NEIGHBOR_OFFSETS[:, 0]).ravel()
+            xs = (chunk_xs[:, None] + NEIGHBOR_OFFSETS[:, 1]).ravel()
+            codes = np.tile(NEIGHBOR_CODES, len(chunk_ys))
+
+            # drop neighbors that fall off the edge of the raster
+            inside = (ys >= 0) & (ys < grid.ysize) & (xs >= 0) & (xs < grid.xsize)
+            ys, xs, codes = ys[inside], xs[inside], codes[inside]
 
-contributions = {
-    (0, 0): 2,
-    (0, 1): 4,
-    (0, 2): 8,
-    (1, 0): 1,
-    (1, 1): 0,
-    (1, 2): 16,
-    (2, 0): 128,
-    (2, 1): 64,
-    (2, 2): 32
-}
+            # keep only neighbors that drain into the frontier cell
+            drains = grid.values(ys, xs) == codes
+            ys, xs = ys[drains], xs[drains]
 
+            new = ~visited.get(ys, xs)
+            ys, xs = ys[new], xs[new]
+            if include is not None and len(ys):
+                keep = include(xs, ys)
+                ys, xs = ys[keep], xs[keep]
 
-def delineate_missing_from_grid(point, region, dirpath, geodriver, cell_size, mask=None):
+            visited.set(ys, xs)
+            yield xs, ys
+            next_ys.append(ys)
+            next_xs.append(xs)
 
-    src = {}
+        frontier_ys = np.concatenate(next_ys)
+        frontier_xs = np.concatenate(next_xs)
 
-    # this is critically important: catchment entries represent points that are in the catchment to be returned
-    catchments = {}
+
+def trace_upstream(grid, x, y, include=None):
+    """
+    Find all cells draining to (x, y) with a breadth-first search over the flow direction grid.
+
+    :param grid: a TiledGrid over the flow direction band
+    :param x: column of the pour point
+    :param y: row of the pour point
+    :param include: optional function taking arrays (xs, ys) and returning a boolean array of cells that may be added
+    :return: arrays (xs, ys) of all cells in the catchment, including the pour point
+    """
+
+    visited = TiledMask(grid.xsize, grid.ysize, grid.tile_size)
+    found = list(trace_levels(grid, x, y, visited, include=include))
+    return np.concatenate([xs for xs, ys in found]), np.concatenate([ys for xs, ys in found])
+
+
+def rasterize_mask(mask, gt, xsize, ysize, centers=False):
+    """
+    Burn a polygon onto the window of the grid covering it.
+
+    Cells are tested by their top-left corners, as the vector test mask.contains(Point(*xy2lonlat(x, y, gt))) did.
+    HydroBASINS polygons follow cell edges, so many corners lie on the boundary, where the scanline rule of rasterize
+    keeps some points that contains rejects; cells within half a cell of the boundary are tested with contains instead.
+
+    :param centers: test the centers of cells rather than their top-left corners, as burn() does
+    :return: (x0, y0, array), where array[y - y0, x - x0] is True if the top-left corner of cell (x, y) is in the
+        polygon (not on its boundary), or with centers, its center
+    """
+    minx, miny, maxx, maxy = mask.bounds
+    x0, y0 = lonlat2xy(minx, maxy, gt)
+    x1, y1 = lonlat2xy(maxx, miny, gt)
+    x0, y0 = max(x0 - 1, 0), max(y0 - 1, 0)
+    x1, y1 = min(x1 + 1, xsize - 1), min(y1 + 1, ysize - 1)
+    if x1 < x0 or y1 < y0:
+        return x0, y0, np.zeros((0, 0), dtype=bool)
+
+    # rasterize tests cell centers, so shift the window by half a cell to test the corners instead
+    lon0, lat0 = xy2lonlat(x0, y0, gt)
+    width, height = gt[1], -gt[5]
+    offset = 0.5 if centers else 0
+    affine = from_origin(lon0 - (0.5 - offset) * width, lat0 + (0.5 - offset) * height, width, height)
+    out_shape = (y1 - y0 + 1, x1 - x0 + 1)
+    array = features.rasterize([(mapping(mask), 1)], out_shape=out_shape, transform=affine, fill=0, dtype='uint8')
+    array = array.astype(bool)
+
+    # the cells whose test points are within half a cell of the boundary, tested exactly
+    edge = features.rasterize([(mapping(mask.boundary), 1)], out_shape=out_shape, transform=affine, fill=0,
+                              dtype='uint8', all_touched=True)
+    prepared = prep(mask)
+    for row, col in zip(*np.nonzero(edge)):
+        lon, lat = xy2lonlat(x0 + col + offset, y0 + row + offset, gt)
+        array[row, col] = prepared.contains(Point(lon, lat))
+
+    return x0, y0, array
+
+
+def mask_filter(mask, gt, xsize, ysize, centers=False):
+    """
+    A function taking arrays (xs, ys) and returning a boolean array of the cells within mask, as in rasterize_mask, to
+    use as the include function of trace_upstream
+    """
+    x0, y0, inside = rasterize_mask(mask, gt, xsize, ysize, centers=centers)
+
+    def include(xs, ys):
+        rows = ys - y0
+        cols = xs - x0
+        within = (rows >= 0) & (rows < inside.shape[0]) & (cols >= 0) & (cols < inside.shape[1])
+        result = np.zeros(len(xs), dtype=bool)
+        result[within] = inside[rows[within], cols[within]]
+        return result
+
+    return include
+
+
+def stop_filter(stop, xsize, found, include=None):
+    """
+    An include function for trace_upstream that leaves out the (x, y) stop cells, and so everything upstream of them,
+    as well as any cells include leaves out. The stop cells met are appended to found; since the search never goes
+    upstream of one, they are the outermost ones.
+    """
+    stop_keys = np.array(sorted(sx + sy * xsize for sx, sy in stop), dtype=np.int64)
+
+    def keep_cells(xs, ys):
+        keep = include(xs, ys) if include else np.ones(len(xs), dtype=bool)
+        stops = np.in1d(xs.astype(np.int64) + ys.astype(np.int64) * xsize, stop_keys) & keep
+        found.extend(zip(xs[stops].tolist(), ys[stops].tolist()))
+        return keep & ~stops
+
+    return keep_cells
+
+
+def trace_missing_cells(point, region, dirpath, cell_size, mask=None, trace=None, stop=None, reached=None,
+                        centers=False):
+    """
+    The flow direction grid cells draining to a point, limited to those within mask if given.
+
+    :param stop: optional (x, y) cells whose catchments are known; tracing stops at them, leaving them and everything
+        upstream of them out
+    :param reached: optional list, to which the outermost stop cells that drain to the point are appended
+    :param centers: keep the cells whose centers are in mask, rather than their top-left corners (see rasterize_mask)
+    :return: (xs, ys, gt), or None if the point is off the grid
+    """
+
+    trace = trace or Trace()
 
     # initialize pour point
     lon, lat = point
 
-    fdir = None
-
-    bil = gdal.Open(dirpath.format(region, cell_size))
+    bilpath = dirpath.format(region, cell_size)
+    bil = open_raster(dirpath, region, cell_size)
     gt = bil.GetGeoTransform()
-    fdir = bil.GetRasterBand(1)
+    grid = TiledGrid(bil.GetRasterBand(1))
     x, y = lonlat2xy(lon, lat, gt)
 
-    # the core routine to find the catchment
-    def add_to_catchment(x, y, xt, yt, val=1, depth=0, overlap=0):
-        area = fdir.ReadAsArray(x - 1, y - 1, 3, 3)  # does not account for edge cases yet
-
-        catchments[(xt, yt)] = val
-
-        if overlap or depth == 950:
-            return
-
-        for i in range(3):  # rows
-            for j in range(3):  # columns
-                if area[i, j] == contributions[(i, j)]:
-                    xnew = x + (j - 1)
-                    ynew = y + (i - 1)
-                    xtnew = xt + (j - 1)
-                    ytnew = yt + (i - 1)
-
-                    # need to update region here based on xnew, ynew
-                    # in the meantime, just assume the region is the same
-                    if (xtnew, ytnew) not in catchments:
-                        lonnew, latnew = xy2lonlat(xtnew, ytnew, gt)
-                        if not mask or mask.contains(Point(lonnew, latnew)):
-                            add_to_catchment(xnew, ynew, xtnew, ytnew, val, depth=depth + 1)
-
-    # update catchments
-    try:
-        add_to_catchment(x, y, xt=x, yt=y)
-    except:
+    if not (0 <= x < grid.xsize and 0 <= y < grid.ysize):
         return None
 
+    include = None
+    if mask:
+        with trace.stage('grid_mask'):
+            include = mask_filter(mask, gt, grid.xsize, grid.ysize, centers=centers)
+
+    found = []
+    if stop:
+        include = stop_filter(stop, grid.xsize, found, include)
+
+    # the core routine to find the catchment, using the precomputed upstream index if there is one; the index gathers
+    # every cell upstream before any are filtered, so within a mask, which the search never leaves, it is not used
+    with trace.stage('grid_trace'):
+        cells = None
+        index = load_upstream_index(bilpath) if mask is None else None
+        if index is not None:
+            cells = upstream_cells(index, x, y, stop=stop, reached=reached)
+        if cells is None:
+            cells = trace_upstream(grid, x, y, include=include)
+            if reached is not None:
+                reached.extend(found)
+        xs, ys = cells
+    trace.count('cells_visited', len(xs))
+    trace.count('gdal_reads', grid.reads)
+
+    return xs, ys, gt
+
+
+def grid_coordinates(x0, y0, gt):
+    """
+    A function for shapely.ops.transform from columns and rows of a window whose top-left cell is (x0, y0) to map
+    coordinates. Vertices are computed from their cell in the whole grid, so polygonized windows and tiles share their
+    edges exactly, and union without slivers.
+    """
+
+    def to_lonlat(cols, rows):
+        return (np.asarray(cols) + x0) * gt[1] + gt[0], (np.asarray(rows) + y0) * gt[5] + gt[3]
+
+    return to_lonlat
+
+
+def polygonize(array, x0, y0, gt, trace=None):
+    """
+    The polygon covering the nonzero cells of a uint8 array of 0s and 1s, whose top-left cell is (x0, y0) of the grid.
+
+    Each 4-connected group of cells becomes one polygon, with its holes. Groups touching only at corners stay separate
+    polygons of a MultiPolygon, so no union is needed.
+    """
+
+    trace = trace or Trace()
+
+    # create the shapes in columns and rows, with the array itself as the mask
+    shapes = features.shapes(array, mask=array.view(bool), connectivity=4)
+    to_lonlat = grid_coordinates(x0, y0, gt)
+    polygons = [transform(to_lonlat, shape(geometry)) for geometry, value in shapes]
+    trace.count('polygons_traced', len(polygons))
+
+    # there may be more than one main feature
+    if len(polygons) == 1:
+        return polygons[0]
+    return MultiPolygon(polygons)
+
+
+def polygonize_cells(xs, ys, gt, trace=None):
+    """The polygon covering the grid cells (xs, ys), polygonized over the window around them"""
+
     # create numpy array
-    xmin = min([x for (x, y) in catchments])
-    xmax = max([x for (x, y) in catchments])
-    ymin = min([y for (x, y) in catchments])
-    ymax = max([y for (x, y) in catchments])
+    xmin = xs.min()
+    ymin = ys.min()
 
     # get the cols & rows
-    cols = xmax - xmin + 1
-    rows = ymax - ymin + 1
-    array = np.zeros((rows, cols), dtype=np.dtype('uint8'))
+    cols = xs.max() - xmin + 1
+    rows = ys.max() - ymin + 1
+    array = np.zeros((rows, cols), dtype=np.uint8)
+    array[ys - ymin, xs - xmin] = 1
 
-    for (x, y), val in catchments.items():
-        array[y - ymin, x - xmin] = val
+    return polygonize(array, xmin, ymin, gt, trace=trace)
 
-    # define raster origin
-    originLon, originLat = xy2lonlat(xmin, ymin, gt)
-    cellWidth = cellHeight = cell_size / 60 / 60
 
-    # create the shapes
-    transform = from_origin(originLon, originLat, cellWidth, cellHeight)
-    mask = array != 0
-    shapes = features.shapes(array, mask=mask, connectivity=8, transform=transform)
+def delineate_missing_from_grid(point, region, dirpath, geodriver, cell_size, mask=None, trace=None):
 
-    # there may be more than one main feature
-    polygons = []
-    for shape, i in shapes:
-        polygons.extend([Polygon(coords) for coords in shape['coordinates']])
-    polygon = cascaded_union(polygons)
+    trace = trace or Trace()
+
+    cells = trace_missing_cells(point, region, dirpath, cell_size, mask=mask, trace=trace)
+    if cells is None:
+        return None
+    xs, ys, gt = cells
+
+    with trace.stage('grid_polygonize'):
+        polygon = polygonize_cells(xs, ys, gt, trace=trace)
 
     return polygon
+
+
+def burn(geometries, xs, ys, gt, trace=None):
+    """
+    The polygon covering geometries and the grid cells (xs, ys), found by burning both onto one raster at the
+    resolution of the grid and polygonizing it once.
+
+    Geometries that follow the edges of the same grid cells, as HydroBASINS polygons and earlier delineations do, leave
+    no slivers between the parts.
+    """
+
+    trace = trace or Trace()
+
+    # the window covering all parts, which may extend beyond the flow direction grid
+    x0, y0, x1, y1 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+    for geometry in geometries:
+        minx, miny, maxx, maxy = geometry.bounds
+        x0 = min(int(np.floor((minx - gt[0]) / gt[1])), x0)
+        y0 = min(int(np.floor((maxy - gt[3]) / gt[5])), y0)
+        x1 = max(int(np.ceil((maxx - gt[0]) / gt[1])), x1)
+        y1 = max(int(np.ceil((miny - gt[3]) / gt[5])), y1)
+
+    # cells with their centers in the geometries, then the traced cells
+    lon0, lat0 = xy2lonlat(x0, y0, gt)
+    affine = from_origin(lon0, lat0, gt[1], -gt[5])
+    if geometries:
+        array = features.rasterize([(mapping(geometry), 1) for geometry in geometries], out_shape=(y1 - y0, x1 - x0),
+                                   transform=affine, fill=0, dtype='uint8')
+    else:
+        array = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    array[ys - y0, xs - x0] = 1
+    trace.count('cells_merged', int(array.sum()))
+
+    return polygonize(array, x0, y0, gt, trace=trace)
+
+
+def merge_in_raster(main, point, region, dirpath, cell_size, mask=None, trace=None):
+    """
+    Merge the HydroBASINS part of a hybrid delineation with the grid cells draining to the point within mask, by
+    burning both onto one raster at the resolution of the flow direction grid and polygonizing it once.
+
+    Both the mask and the HydroBASINS part are burned by cell center, so the cells of the pour basin meet those of the
+    basins upstream of it without a gap.
+    """
+
+    trace = trace or Trace()
+
+    cells = trace_missing_cells(point, region, dirpath, cell_size, mask=mask, trace=trace, centers=True)
+    if cells is None:
+        return main
+    xs, ys, gt = cells
+
+    with trace.stage('raster_merge'):
+        polygon = burn([main], xs, ys, gt, trace=trace)
+
+    return polygon
+
+
+def delineate_from_upstream(point, region, dirpath, cell_size, upstream, trace=None):
+    """
+    Delineate a point by tracing only down from the known catchments upstream of it.
+
+    Only the new cells are polygonized, and the known catchments are unioned with them. Their footprints follow the
+    same cell edges, so the union leaves no slivers, and its cost grows with their outlines rather than their areas.
+
+    :param upstream: dict of (x, y) cells whose catchments are known to functions returning their footprints
+    :return: (polygon, number of known catchments used), or (None, 0) if the point is off the grid
+    """
+
+    trace = trace or Trace()
+
+    reached = []
+    cells = trace_missing_cells(point, region, dirpath, cell_size, trace=trace, stop=list(upstream), reached=reached)
+    if cells is None:
+        return None, 0
+    xs, ys, gt = cells
+
+    with trace.stage('grid_polygonize'):
+        polygon = polygonize_cells(xs, ys, gt, trace=trace)
+
+    with trace.stage('union'):
+        geometries = [upstream[cell]() for cell in reached]
+        if geometries:
+            polygon = cascaded_union([polygon] + geometries)
+        trace.count('polygons_unioned', len(geometries))
+
+    return polygon, len(geometries)
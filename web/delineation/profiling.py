@@ -0,0 +1,49 @@
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
+
+
+class Trace(object):
+    """
+    What one delineation did: wall-clock seconds spent in each named stage, accumulated over repeated entries, and
+    counters such as cells visited, GDAL block reads and cache hits.
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.counts = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time() - start
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def to_dict(self):
+        return {'timings': dict(self.timings), 'counts': dict(self.counts)}
+
+
+def memory_usage():
+    """
+    Resident memory of this process, in MB, as {'rss', 'pss', 'shared'}. The proportional set size (pss) counts pages
+    shared with other processes, e.g., forked workers, once between them; it is only known on Linux.
+    """
+    usage = {}
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared', 'Shared_Dirty': 'shared'}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, kb = line.split()[:2]
+                if name.rstrip(':') in fields:
+                    key = fields[name.rstrip(':')]
+                    usage[key] = usage.get(key, 0) + int(kb) / 1024
+    except (IOError, OSError):
+        # peak rather than current, where /proc is not available
+        usage['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return usage
@@ -0,0 +1,76 @@
+import os
+
+from osgeo import gdal
+import rasterio
+
+# size of GDAL's raster block cache, shared by all open datasets in a process
+GDAL_CACHE_MB = int(os.environ.get('CUENCAS_GDAL_CACHE_MB', 512))
+
+
+def configure_gdal():
+    """Register the drivers used for HydroSHEDS grids and set the block cache size, once per process"""
+    for name in ['EHdr', 'GTiff']:
+        driver = gdal.GetDriverByName(name)
+        if driver is not None:
+            driver.Register()
+    gdal.SetCacheMax(GDAL_CACHE_MB * 1024 * 1024)
+
+
+class RasterPool(object):
+    """
+    Raster datasets kept open for the life of a process, keyed by (grid path, region, cell_size).
+
+    Handles are not shared across a fork: a child process that inherits the pool drops them and reopens its own.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.datasets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.datasets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, region, cell_size, library='gdal'):
+        """
+        An open dataset for path.format(region, cell_size), or None if GDAL cannot open it.
+
+        :param library: 'gdal' for a gdal.Dataset or 'rasterio' for a rasterio dataset
+        """
+        if os.getpid() != self.pid:
+            self.reset()
+        key = (path, region, cell_size, library)
+        if key in self.datasets:
+            self.hits += 1
+            return self.datasets[key]
+        self.misses += 1
+        filename = path.format(region, cell_size)
+        if library == 'rasterio':
+            dataset = rasterio.open(filename)
+        else:
+            dataset = gdal.Open(filename)
+        if dataset is not None:
+            self.datasets[key] = dataset
+        return dataset
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'open': len(self.datasets)}
+
+
+configure_gdal()
+
+pool = RasterPool()
+
+
+def open_raster(path, region, cell_size):
+    """Pooled gdal.Dataset for a HydroSHEDS grid, e.g., open_raster(dirpath, 'na', 15)"""
+    return pool.get(path, region, cell_size)
+
+
+def open_rasterio(path, region, cell_size):
+    """Pooled rasterio dataset for a HydroSHEDS grid"""
+    return pool.get(path, region, cell_size, library='rasterio')
@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+from osgeo import gdal
+from rasterio import features
+from rasterio.transform import from_origin
+from shapely.geometry import mapping
+
+from . import datasets
+from .utils import find_hydrosheds_region, region01_candidates
+
+# lookup cells per degree; region boundaries in utils are whole degrees, so each cell has a single guess sequence
+RESOLUTION = 8
+
+GRID_REGIONS = ['af', 'as', 'au', 'ca', 'eu', 'na', 'sa']
+BASIN_REGIONS = ['af', 'ar', 'as', 'au', 'eu', 'na', 'sa', 'si']
+# lookup values are 1 + the position of a region in these lists, or 0 where the region must be found the slow way
+
+# flow direction value outside the HydroSHEDS land mask
+NODATA = 247
+
+_lookups = {}
+
+
+def lookup_path(rootpath, cell_size=15):
+    return os.path.join(rootpath, 'regions_{}s.npz'.format(cell_size))
+
+
+def _cell(point):
+    """Row and column of the lookup cell containing point, or None if point is on a cell edge"""
+    lng, lat = point
+    col = (lng + 180) * RESOLUTION
+    row = (90 - lat) * RESOLUTION
+    if col == int(col) or row == int(row):
+        return None
+    return int(row), int(col)
+
+
+def _grid_coverage(bilpath, shape):
+    """Whether any and all cells of the flow direction grid have data within each lookup cell"""
+    any_valid = np.zeros(shape, dtype=bool)
+    all_valid = np.zeros(shape, dtype=bool)
+
+    bil = gdal.Open(bilpath)
+    gt = bil.GetGeoTransform()
+    band = bil.GetRasterBand(1)
+    block = int(round(1.0 / RESOLUTION / gt[1]))
+    col0 = int(round((gt[0] + 180) * RESOLUTION))
+    row0 = int(round((90 - gt[3]) * RESOLUTION))
+    ncols = -(-band.XSize // block)
+
+    for i, y in enumerate(range(0, band.YSize, block)):
+        rows = min(block, band.YSize - y)
+        strip = np.full((block, ncols * block), NODATA, dtype=np.uint8)
+        strip[:rows, :band.XSize] = band.ReadAsArray(0, y, band.XSize, rows)
+        # get_grid_region also rejects cells with value 0
+        valid = ((strip != NODATA) & (strip != 0)).reshape(block, ncols, block)
+        row = row0 + i
+        if not 0 <= row < shape[0]:
+            continue
+        cols = slice(max(col0, 0), min(col0 + ncols, shape[1]))
+        within = slice(cols.start - col0, cols.stop - col0)
+        any_valid[row, cols] = valid.any(axis=(0, 2))[within]
+        all_valid[row, cols] = valid.all(axis=(0, 2))[within]
+
+    return any_valid, all_valid
+
+
+def build_region_lookup(rootpath, cell_size=15):
+    """
+    Build a global grid of HydroSHEDS grid regions and HydroBASINS regions, as get_grid_region and get_region01 would
+    find them for every point in each cell. Cells where the answer differs within the cell are left as 0.
+    """
+    shape = (180 * RESOLUTION, 360 * RESOLUTION)
+    transform = from_origin(-180, 90, 1.0 / RESOLUTION, 1.0 / RESOLUTION)
+
+    # HydroSHEDS: follow the same guesses as get_grid_region, accepting a guess only if all of the cell has data
+    coverage = {}
+    for region in GRID_REGIONS:
+        bilpath = os.path.join(rootpath, 'hydrosheds', '{}_dir_{}s.bil'.format(region, cell_size))
+        if os.path.exists(bilpath):
+            coverage[region] = _grid_coverage(bilpath, shape)
+
+    grid = np.zeros(shape, dtype=np.uint8)
+    if coverage:
+        rows, cols = np.nonzero(np.any([any_valid for any_valid, all_valid in coverage.values()], axis=0))
+        for row, col in zip(rows, cols):
+            lat = 90 - (row + 0.5) / RESOLUTION
+            lng = (col + 0.5) / RESOLUTION - 180
+            region = None
+            while True:
+                guess = find_hydrosheds_region(lat, lng, exclude=region)
+                if guess is None or guess == region or guess not in coverage:
+                    break
+                any_valid, all_valid = coverage[guess]
+                if all_valid[row, col]:
+                    grid[row, col] = GRID_REGIONS.index(guess) + 1
+                    break
+                elif any_valid[row, col]:
+                    break
+                region = guess
+
+    # HydroBASINS: a cell belongs to a region if it is entirely inside that region's level 1 polygon and outside all
+    # others, and the region is one get_region01 would search
+    touches = np.zeros(shape, dtype=np.uint8)
+    inside = np.zeros(shape, dtype=np.uint8)
+    for i, region in enumerate(BASIN_REGIONS):
+        if not os.path.exists(datasets.basins_path(rootpath, region, 1)):
+            continue
+        geometries = list(datasets.get_basins(rootpath, region, 1)['geometry'])
+        touched = features.rasterize([(mapping(g), 1) for g in geometries], out_shape=shape, transform=transform,
+                                     all_touched=True, dtype='uint8')
+        edges = features.rasterize([(mapping(g.boundary), 1) for g in geometries], out_shape=shape,
+                                   transform=transform, all_touched=True, dtype='uint8')
+        touches += touched
+        inside[(touched == 1) & (edges == 0)] = i + 1
+
+    basins = np.where(touches == 1, inside, 0).astype(np.uint8)
+    for row, col in zip(*np.nonzero(basins)):
+        point = ((col + 0.5) / RESOLUTION - 180, 90 - (row + 0.5) / RESOLUTION)
+        if BASIN_REGIONS[basins[row, col] - 1] not in region01_candidates(point):
+            basins[row, col] = 0
+
+    path = lookup_path(rootpath, cell_size)
+    tmppath = path + '.tmp.npz'
+    np.savez_compressed(tmppath, grid=grid, basins=basins)
+    os.rename(tmppath, path)
+
+
+def load_region_lookup(rootpath, cell_size=15):
+    """The region lookup grids, as a dict of arrays, or None if they have not been built"""
+    key = (rootpath, cell_size)
+    if key not in _lookups:
+        path = lookup_path(rootpath, cell_size)
+        if os.path.exists(path):
+            with np.load(path) as npz:
+                _lookups[key] = {'grid': npz['grid'], 'basins': npz['basins']}
+        else:
+            _lookups[key] = None
+    return _lookups[key]
+
+
+def lookup_regions(rootpath, point, cell_size=15):
+    """
+    HydroSHEDS grid region and HydroBASINS region of a point from the lookup grids, as (grid_region, region01).
+
+    Either is None if the lookup cannot decide it.
+    """
+    lookup = load_region_lookup(rootpath, cell_size)
+    cell = _cell(point)
+    if lookup is None or cell is None or not (0 <= cell[0] < 180 * RESOLUTION and 0 <= cell[1] < 360 * RESOLUTION):
+        return None, None
+    grid_code = lookup['grid'][cell]
+    basin_code = lookup['basins'][cell]
+    grid_region = GRID_REGIONS[grid_code - 1] if grid_code else None
+    region01 = BASIN_REGIONS[basin_code - 1] if basin_code else None
+    return grid_region, region01
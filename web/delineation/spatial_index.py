@@ -0,0 +1,33 @@
+from shapely.geometry import Point, box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+
+class BasinIndex(object):
+    """R-tree over a list of basin geometries, for point-in-basin lookups"""
+
+    def __init__(self, geometries):
+        self.geometries = list(geometries)
+        self.prepared = [prep(g) for g in self.geometries]
+        self.positions = {id(g): i for i, g in enumerate(self.geometries)}
+        self.tree = STRtree(self.geometries)
+
+    def query(self, geometry):
+        """Positions of the geometries whose bounds intersect geometry"""
+        results = self.tree.query(geometry)
+        # older shapely returns the geometries themselves, newer returns their positions
+        return sorted(self.positions[id(r)] if hasattr(r, 'geom_type') else int(r) for r in results)
+
+    def locate(self, point, tolerance=0.0):
+        """
+        Positions of the geometries containing point, in their original order.
+
+        If none contains it and tolerance is given, those within tolerance of the point are returned instead.
+        """
+        location = Point(point)
+        found = [i for i in self.query(location) if self.prepared[i].contains(location)]
+        if not found and tolerance:
+            lng, lat = point
+            area = box(lng - tolerance, lat - tolerance, lng + tolerance, lat + tolerance)
+            found = [i for i in self.query(area) if self.prepared[i].intersects(area)]
+        return found
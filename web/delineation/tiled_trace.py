@@ -0,0 +1,293 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from rasterio import features
+from rasterio.transform import from_origin
+from shapely.geometry import MultiPolygon, box, mapping, shape
+from shapely.ops import cascaded_union, transform
+from shapely.prepared import prep
+
+from .grid_search import TILE_SIZE, TiledGrid, _group_by_tile, grid_coordinates, mask_filter, stop_filter, \
+    trace_levels
+from .profiling import Trace
+from .rasters import open_raster
+from .upstream_index import load_upstream_index, upstream_runs
+from .utils import lonlat2xy, xy2lonlat
+
+# memory a bounded trace may use for flow directions and visited cells, together
+TRACE_MEMORY_MB = int(os.environ.get('CUENCAS_TRACE_MEMORY_MB', 1024))
+
+# rough bytes held per catchment cell by the in-memory tracer: coordinates, visited mask and polygonizing array
+BYTES_PER_CELL = 24
+
+# frontier cells expanded, or index entries read, at a time
+CHUNK_SIZE = 1 << 20
+
+
+def needs_bounded_trace(cells, max_mb=TRACE_MEMORY_MB):
+    """Whether tracing a catchment of this many cells in memory would exceed the trace memory budget"""
+    return cells * BYTES_PER_CELL > max_mb * 1024 * 1024
+
+
+def window_cells(geometries, cell_size):
+    """Number of grid cells in the bounding box of geometries, which a raster merge of them burns"""
+    bounds = [g.bounds for g in geometries]
+    width = max(b[2] for b in bounds) - min(b[0] for b in bounds)
+    height = max(b[3] for b in bounds) - min(b[1] for b in bounds)
+    return int(width * height / (cell_size / 3600) ** 2)
+
+
+class BitsetTiles(object):
+    """
+    Sparse boolean raster stored as one packed bitset per tile, with the same get and set methods as TiledMask.
+
+    At most max_bytes of tiles are kept in memory; the least recently used beyond that are spilled to a temporary
+    directory and read back when needed. close() removes the directory.
+    """
+
+    def __init__(self, xsize, ysize, tile_size=TILE_SIZE, max_bytes=TRACE_MEMORY_MB * 1024 * 1024):
+        self.tile_size = tile_size
+        self.ntx = -(-xsize // tile_size)
+        self.nbytes = tile_size * tile_size // 8
+        self.max_tiles = max(1, max_bytes // self.nbytes)
+        self.tiles = OrderedDict()
+        self.spilled = set()
+        self.path = None
+        self.spills = 0
+
+    def filename(self, key):
+        return os.path.join(self.path, '{}_{}.bits'.format(*key))
+
+    def bits(self, key, create=False):
+        """The bitset of a tile, from memory or disk, or a new one if create; None if the tile has no cells set"""
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        if key in self.spilled:
+            bits = np.fromfile(self.filename(key), dtype=np.uint8)
+        elif create:
+            bits = np.zeros(self.nbytes, dtype=np.uint8)
+        else:
+            return None
+        self.tiles[key] = bits
+        while len(self.tiles) > self.max_tiles:
+            self.spill()
+        return bits
+
+    def spill(self):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='cuencas-trace-')
+        key, bits = self.tiles.popitem(last=False)
+        bits.tofile(self.filename(key))
+        self.spilled.add(key)
+        self.spills += 1
+
+    def _offsets(self, ys, xs, ty, tx):
+        return (ys - ty * self.tile_size) * self.tile_size + (xs - tx * self.tile_size)
+
+    def get(self, ys, xs):
+        values = np.zeros(len(ys), dtype=bool)
+        for ty, tx, sel in _group_by_tile(ys, xs, self.tile_size, self.ntx):
+            bits = self.bits((ty, tx))
+            if bits is not None:
+                offsets = self._offsets(ys[sel], xs[sel], ty, tx)
+                values[sel] = (bits[offsets >> 3] >> (7 - (offsets & 7))) & 1
+        return values
+
+    def set(self, ys, xs):
+        for ty, tx, sel in _group_by_tile(ys, xs, self.tile_size, self.ntx):
+            bits = self.bits((ty, tx), create=True)
+            offsets = self._offsets(ys[sel], xs[sel], ty, tx)
+            # bit order as in np.packbits: the first cell is the most significant bit
+            np.bitwise_or.at(bits, offsets >> 3, (128 >> (offsets & 7)).astype(np.uint8))
+
+    def keys(self):
+        return sorted(set(self.tiles) | self.spilled)
+
+    def array(self, key):
+        """A tile as a uint8 array of 0s and 1s"""
+        return np.unpackbits(self.bits(key)).reshape(self.tile_size, self.tile_size)
+
+    def close(self):
+        self.tiles.clear()
+        self.spilled.clear()
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+
+def mark_upstream_cells(index, x, y, visited, stop=None, reached=None):
+    """
+    Mark the cells draining to (x, y) in visited, reading the upstream index a chunk at a time, and return their
+    number, or None if the pour point is not indexed. stop and reached are as in upstream_cells.
+    """
+    found = upstream_runs(index, x, y, stop)
+    if found is None:
+        return None
+    runs, outermost = found
+    if reached is not None:
+        reached.extend(outermost)
+    for start, end in runs:
+        for i in range(start, end, CHUNK_SIZE):
+            cells = np.asarray(index.order[i:min(i + CHUNK_SIZE, end)], dtype=np.int64)
+            ys, xs = np.divmod(cells, index.rank.shape[1])
+            visited.set(ys, xs)
+    return sum(end - start for start, end in runs)
+
+
+def polygonize_tiles(visited, gt, trace=None):
+    """
+    Polygonize a BitsetTiles one tile at a time, and stitch together the polygons that reach the edges of their tiles.
+    Only one tile is unpacked at a time.
+    """
+
+    trace = trace or Trace()
+    size = visited.tile_size
+
+    interior = []
+    edge = []
+    for ty, tx in visited.keys():
+        array = visited.array((ty, tx))
+
+        to_lonlat = grid_coordinates(tx * size, ty * size, gt)
+        for geometry, value in features.shapes(array, mask=array.view(bool), connectivity=4):
+            polygon = shape(geometry)
+            minx, miny, maxx, maxy = polygon.bounds
+            polygon = transform(to_lonlat, polygon)
+            if minx == 0 or miny == 0 or maxx == size or maxy == size:
+                edge.append(polygon)
+            else:
+                interior.append(polygon)
+    trace.count('polygons_traced', len(interior) + len(edge))
+    trace.count('polygons_unioned', len(edge))
+
+    polygons = interior
+    if edge:
+        stitched = cascaded_union(edge)
+        polygons = polygons + list(getattr(stitched, 'geoms', [stitched]))
+    if len(polygons) == 1:
+        return polygons[0]
+    return MultiPolygon(polygons)
+
+
+def burn_tiles(visited, geometries, gt, xsize, ysize):
+    """
+    Mark the cells of the grid with their centers in geometries in visited, as burn() does, one tile at a time.
+
+    :return: the parts of geometries beyond the edges of the grid, or None
+    """
+    size = visited.tile_size
+    west, north = xy2lonlat(0, 0, gt)
+    east, south = xy2lonlat(xsize, ysize, gt)
+    extent = box(west, south, east, north)
+
+    minx = min(g.bounds[0] for g in geometries)
+    miny = min(g.bounds[1] for g in geometries)
+    maxx = max(g.bounds[2] for g in geometries)
+    maxy = max(g.bounds[3] for g in geometries)
+    x0, y0 = lonlat2xy(max(minx, west), min(maxy, north), gt)
+    x1, y1 = lonlat2xy(min(maxx, east), max(miny, south), gt)
+    x1, y1 = min(x1, xsize - 1), min(y1, ysize - 1)
+
+    prepared = [(prep(g), g) for g in geometries]
+    for ty in range(y0 // size, y1 // size + 1):
+        for tx in range(x0 // size, x1 // size + 1):
+            lon0, lat0 = xy2lonlat(tx * size, ty * size, gt)
+            lon1, lat1 = xy2lonlat((tx + 1) * size, (ty + 1) * size, gt)
+            tile = box(lon0, lat1, lon1, lat0)
+            shapes = [(mapping(g), 1) for p, g in prepared if p.intersects(tile)]
+            if not shapes:
+                continue
+            affine = from_origin(lon0, lat0, gt[1], -gt[5])
+            array = features.rasterize(shapes, out_shape=(size, size), transform=affine, fill=0, dtype='uint8')
+            ys, xs = np.nonzero(array)
+            ys, xs = ys + ty * size, xs + tx * size
+            inside = (ys < ysize) & (xs < xsize)
+            visited.set(ys[inside], xs[inside])
+
+    outside = [g.difference(extent) for g in geometries if not extent.contains(g)]
+    outside = [g for g in outside if not g.is_empty]
+    return cascaded_union(outside) if outside else None
+
+
+def delineate_bounded(point, region, dirpath, cell_size, mask=None, main=None, upstream=None, max_mb=TRACE_MEMORY_MB,
+                      trace=None):
+    """
+    Delineate a point from the flow direction grid within a memory budget of about max_mb, for catchments too large to
+    trace in memory: visited cells are kept as per-tile bitsets, spilled to disk beyond half the budget, flow
+    directions are read through a cache of at most the other half, and the result is polygonized tile by tile.
+
+    The HydroBASINS part is burned onto the same tiles, and known catchments upstream are unioned with the polygon, as
+    in delineate_from_upstream, so only the polygon returned, and the geometries merged in, are not bounded.
+
+    :param mask: optional polygon the traced cells are limited to, as in trace_missing_cells
+    :param main: optional HydroBASINS part of a hybrid delineation, merged in as by merge_in_raster, with the mask
+        tested by cell center
+    :param upstream: optional catchments known upstream, as taken by delineate_from_upstream; the number merged in is
+        counted in trace as 'catchments_reused'
+    """
+
+    trace = trace or Trace()
+
+    lon, lat = point
+    bilpath = dirpath.format(region, cell_size)
+    bil = open_raster(dirpath, region, cell_size)
+    gt = bil.GetGeoTransform()
+    band = bil.GetRasterBand(1)
+    x, y = lonlat2xy(lon, lat, gt)
+
+    if not (0 <= x < band.XSize and 0 <= y < band.YSize):
+        return None
+
+    budget = max_mb * 1024 * 1024 // 2
+    visited = BitsetTiles(band.XSize, band.YSize, max_bytes=budget)
+    grid = TiledGrid(band, max_tiles=max(1, budget // (TILE_SIZE * TILE_SIZE)))
+
+    include = None
+    if mask:
+        with trace.stage('grid_mask'):
+            include = mask_filter(mask, gt, band.XSize, band.YSize, centers=main is not None)
+    stop = list(upstream) if upstream else None
+    found = []
+    if stop:
+        include = stop_filter(stop, band.XSize, found, include)
+
+    try:
+        with trace.stage('grid_trace'):
+            cells = None
+            reached = []
+            # as in trace_missing_cells, the index is only used for whole catchments
+            index = load_upstream_index(bilpath) if mask is None else None
+            if index is not None:
+                cells = mark_upstream_cells(index, x, y, visited, stop=stop, reached=reached)
+            if cells is None:
+                cells = sum(len(xs) for xs, ys in trace_levels(grid, x, y, visited, include=include,
+                                                               chunk_size=CHUNK_SIZE))
+                reached.extend(found)
+        trace.count('cells_visited', cells)
+        trace.count('gdal_reads', grid.reads)
+
+        outside = None
+        if main is not None:
+            with trace.stage('raster_merge'):
+                outside = burn_tiles(visited, [main], gt, band.XSize, band.YSize)
+
+        with trace.stage('grid_polygonize'):
+            polygon = polygonize_tiles(visited, gt, trace=trace)
+        trace.count('tiles_spilled', visited.spills)
+
+        geometries = [outside] if outside is not None else []
+        if upstream:
+            geometries += [upstream[cell]() for cell in reached]
+            trace.count('catchments_reused', len(reached))
+        if geometries:
+            with trace.stage('union'):
+                polygon = cascaded_union([polygon] + geometries)
+
+    finally:
+        visited.close()
+
+    return polygon
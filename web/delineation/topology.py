@@ -0,0 +1,89 @@
+import numpy as np
+
+
+def _ranges(starts, ends):
+    """Concatenation of arange(start, end) for each pair, without a Python loop"""
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+class BasinTopology(object):
+    """Drainage graph of one HydroBASINS layer, as integer arrays indexed by row position in the layer"""
+
+    def __init__(self, basins):
+        self.ids = basins['HYBAS_ID'].values.astype(np.int64)
+        self.main_bas = basins['MAIN_BAS'].values.astype(np.int64)
+        self.next_sink_ids = basins['NEXT_SINK'].values.astype(np.int64)
+        self.order = np.argsort(self.ids)
+        self.sorted_ids = self.ids[self.order]
+
+        # downstream pointers, and their inverse as compressed donor lists
+        self.down = {
+            True: self.positions(basins['NEXT_DOWN'].values.astype(np.int64)),
+            False: self.positions(self.next_sink_ids),
+        }
+        self.donors = {omit_sinks: self._invert(down) for omit_sinks, down in self.down.items()}
+
+    @property
+    def nbytes(self):
+        arrays = [self.ids, self.main_bas, self.next_sink_ids, self.order, self.sorted_ids]
+        arrays += list(self.down.values()) + [a for donors in self.donors.values() for a in donors]
+        return sum(a.nbytes for a in arrays)
+
+    def positions(self, ids):
+        """Row positions of HYBAS_IDs, or -1 for ids (such as 0) not in the layer"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.sorted_ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.sorted_ids, ids), len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[i] == ids, self.order[i], -1)
+
+    def _invert(self, down):
+        drains = np.flatnonzero(down >= 0)
+        receivers = down[drains]
+        sort = np.argsort(receivers, kind='mergesort')
+        indptr = np.searchsorted(receivers[sort], np.arange(len(down) + 1))
+        return indptr, drains[sort]
+
+    def contributing(self, target, candidates, omit_sinks=True):
+        """
+        Find the basins draining to a target basin, following only basins among the candidates.
+
+        This is the same search as the chain walk in get_basins: with omit_sinks, basins whose NEXT_SINK is not their
+        MAIN_BAS do not start a chain, though they are still included if a chain passes through them.
+
+        :param target: row position of the basin to search upstream of
+        :param candidates: boolean array of the basins that may be searched
+        :param omit_sinks: follow NEXT_DOWN and skip sinks if True, otherwise follow NEXT_SINK
+        :return: boolean arrays of the contributing basins, and of the candidates that need not be searched again
+        """
+        down = self.down[omit_sinks]
+        indptr, donors = self.donors[omit_sinks]
+
+        reach = np.zeros(len(self.ids), dtype=bool)
+        seen = reach.copy()
+        seen[target] = True
+        levels = []
+        frontier = np.array([target])
+        while len(frontier):
+            upstream = donors[_ranges(indptr[frontier], indptr[frontier + 1])]
+            upstream = upstream[candidates[upstream] & ~seen[upstream]]
+            seen[upstream] = True
+            reach[upstream] = True
+            levels.append(upstream)
+            frontier = upstream
+
+        # as in the chain walk, the target starts a chain of its own if it drains to itself, as sinks do by NEXT_SINK
+        reach[target] = down[target] == target
+
+        if not omit_sinks:
+            return reach, reach.copy()
+
+        ok = self.main_bas == self.next_sink_ids
+        included = reach & ok
+        for upstream in reversed(levels):
+            receivers = down[upstream[included[upstream]]]
+            included[receivers[receivers != target]] = True
+
+        return included, included | (candidates & ~ok)
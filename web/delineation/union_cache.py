@@ -0,0 +1,71 @@
+import os
+import zlib
+
+from shapely import wkb
+
+from .datasets import LRUCache
+
+# number of dissolved polygons kept in memory per process, in addition to those on disk
+MAX_UNIONS = int(os.environ.get('CUENCAS_MAX_UNIONS', 256))
+
+_caches = {}
+
+
+class UnionCache(object):
+    """
+    Dissolved HydroBASINS polygons, keyed by (kind, region, level, HYBAS_ID, omit_sinks).
+
+    'upstream' entries are the whole HydroBASINS part of a hybrid delineation for a pour basin, and 'level' entries are
+    the contributing subbasins found at one level. Entries are stored on disk as zlib-compressed WKB.
+    """
+
+    def __init__(self, path, maxsize=MAX_UNIONS):
+        self.path = path
+        self.memory = LRUCache(maxsize=maxsize)
+
+    def filename(self, key):
+        kind, region, level, hybas_id, omit_sinks = key
+        sinks = 'nosinks' if omit_sinks else 'sinks'
+        return os.path.join(self.path, '{}_lev{:02}_{}_{}_{}.wkb.z'.format(region, level, hybas_id, sinks, kind))
+
+    def _read(self, key):
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return wkb.loads(zlib.decompress(f.read()))
+
+    def get(self, key):
+        if key in self.memory.items:
+            return self.memory.get(key, None)
+        geometry = self._read(key)
+        if geometry is not None:
+            self.memory.get(key, lambda: geometry)
+        return geometry
+
+    def contains(self, key):
+        return key in self.memory.items or os.path.exists(self.filename(key))
+
+    def put(self, key, geometry):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        filename = self.filename(key)
+        tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            f.write(zlib.compress(wkb.dumps(geometry)))
+        os.rename(tmpname, filename)
+        self.memory.discard(key)
+        self.memory.get(key, lambda: geometry)
+
+    def get_or_create(self, key, create):
+        geometry = self.get(key)
+        if geometry is None:
+            geometry = create()
+            self.put(key, geometry)
+        return geometry
+
+
+def get_union_cache(rootpath):
+    if rootpath not in _caches:
+        _caches[rootpath] = UnionCache(os.path.join(rootpath, 'hydrobasins', 'unions'))
+    return _caches[rootpath]
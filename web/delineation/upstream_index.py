@@ -0,0 +1,191 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+from osgeo import gdal
+
+from .utils import contributions
+
+# rank: position of each cell in a depth-first preorder of the upstream (donor) tree, or -1
+# size: number of cells draining to each cell, including itself
+# order: flat cell indices in preorder, so the catchment of a cell is order[rank:rank + size]
+UpstreamIndex = namedtuple('UpstreamIndex', ['rank', 'size', 'order'])
+
+INDEX_ARRAYS = ['rank', 'size', 'order']
+
+_indexes = {}
+
+
+def index_paths(bilpath):
+    """Paths of the index arrays stored alongside a flow direction grid"""
+    base = os.path.splitext(bilpath)[0]
+    return {name: '{}_upstream_{}.npy'.format(base, name) for name in INDEX_ARRAYS}
+
+
+def build_upstream_index(bilpath):
+    """Build the upstream index for a flow direction grid and save it next to the grid"""
+
+    bil = gdal.Open(bilpath)
+    index = index_arrays(bil.GetRasterBand(1).ReadAsArray())
+    for name, path in index_paths(bilpath).items():
+        tmppath = path + '.tmp.npy'
+        np.save(tmppath, getattr(index, name))
+        os.rename(tmppath, path)
+
+
+def index_arrays(fdir):
+    """
+    Compute the upstream index of a flow direction array.
+
+    Cells are numbered in preorder of the tree formed by inverting the D8 flow directions, so that every catchment is
+    one contiguous run of the order array. Building requires several grid-sized integer arrays in memory.
+    """
+
+    rows, cols = fdir.shape
+    n = rows * cols
+    dtype = np.int32 if n < 2 ** 31 else np.int64
+    codes = fdir.ravel()
+    del fdir
+
+    # the cell each cell drains to, or -1 for outlets, sinks, nodata and cells draining off the grid
+    receiver = np.full(n, -1, dtype=dtype)
+    for (i, j), code in contributions.items():
+        if not code:
+            continue
+        cells = np.flatnonzero(codes == code).astype(dtype)
+        ys, xs = np.divmod(cells, cols)
+        ys += 1 - i
+        xs += 1 - j
+        inside = (ys >= 0) & (ys < rows) & (xs >= 0) & (xs < cols)
+        receiver[cells[inside]] = ys[inside] * cols + xs[inside]
+    del codes
+
+    # peel the tree from its leaves down, accumulating upstream sizes; a parent is always peeled after its donors
+    indegree = np.bincount(receiver[receiver >= 0], minlength=n).astype(dtype)
+    size = np.ones(n, dtype=dtype)
+    batches = []
+    batch = np.flatnonzero(indegree == 0).astype(dtype)
+    while len(batch):
+        batches.append(batch)
+        down = receiver[batch]
+        drains = down >= 0
+        np.add.at(size, down[drains], size[batch[drains]])
+        np.subtract.at(indegree, down[drains], 1)
+        down = np.unique(down[drains])
+        batch = down[indegree[down] == 0]
+    del indegree
+
+    # cells in flow loops are never peeled; anything draining into one is treated as an outlet
+    peeled = np.zeros(n, dtype=bool)
+    for batch in batches:
+        peeled[batch] = True
+    is_root = peeled & ((receiver < 0) | ~peeled[np.maximum(receiver, 0)])
+
+    # offset of each donor's run within its receiver's run: the sizes of the receiver's earlier donors
+    donors = np.flatnonzero(peeled & ~is_root).astype(dtype)
+    receivers = receiver[donors]
+    sort = np.argsort(receivers, kind='mergesort')
+    donors, receivers = donors[sort], receivers[sort]
+    cumulative = np.cumsum(size[donors], dtype=np.int64) - size[donors]
+    first = np.r_[True, receivers[1:] != receivers[:-1]]
+    group_start = np.maximum.accumulate(np.where(first, np.arange(len(donors)), 0))
+    offset = np.zeros(n, dtype=dtype)
+    offset[donors] = cumulative - cumulative[group_start]
+    del donors, receivers, cumulative, first, group_start, sort
+
+    rank = np.full(n, -1, dtype=dtype)
+    roots = np.flatnonzero(is_root).astype(dtype)
+    rank[roots] = np.cumsum(size[roots], dtype=np.int64) - size[roots]
+    for batch in reversed(batches):
+        batch = batch[~is_root[batch]]
+        rank[batch] = rank[receiver[batch]] + 1 + offset[batch]
+    del offset, receiver
+
+    cells = np.flatnonzero(peeled).astype(dtype)
+    order = np.empty(len(cells), dtype=dtype)
+    order[rank[cells]] = cells
+    size[~peeled] = 0
+
+    return UpstreamIndex(rank=rank.reshape(rows, cols), size=size.reshape(rows, cols), order=order)
+
+
+def load_upstream_index(bilpath):
+    """Memory-map the upstream index for a flow direction grid, or return None if it has not been built"""
+    if bilpath not in _indexes:
+        paths = index_paths(bilpath)
+        if all(os.path.exists(path) for path in paths.values()):
+            arrays = {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
+            _indexes[bilpath] = UpstreamIndex(**arrays)
+        else:
+            _indexes[bilpath] = None
+    return _indexes[bilpath]
+
+
+def upstream_runs(index, x, y, stop=None):
+    """
+    The runs of the index holding the cells draining to (x, y), leaving out the catchments of the stop cells.
+
+    Only the pour point and the stop cells are looked up, so leaving out most of a large catchment costs little.
+
+    :param stop: optional (x, y) cells; each one within the catchment removes its own run, and everything upstream
+    :return: ([(start, end), ...] ranges of index.order, the outermost stop cells within the catchment), or None if the
+        pour point is not indexed
+    """
+
+    start = int(index.rank[y, x])
+    if start < 0:
+        return None
+    end = start + int(index.size[y, x])
+
+    # the pour point itself is never left out
+    within = [(sx, sy) for sx, sy in stop or [] if start < int(index.rank[sy, sx]) < end]
+    reached = outermost_cells(index, within)
+
+    runs = []
+    position = start
+    for sx, sy in reached:
+        rank = int(index.rank[sy, sx])
+        if rank > position:
+            runs.append((position, rank))
+        position = rank + int(index.size[sy, sx])
+    if end > position:
+        runs.append((position, end))
+
+    return runs, reached
+
+
+def upstream_cells(index, x, y, stop=None, reached=None):
+    """
+    Find all cells draining to (x, y) with slices of the index.
+
+    :param index: an UpstreamIndex
+    :param x: column of the pour point
+    :param y: row of the pour point
+    :param stop: optional (x, y) cells whose catchments are left out, as in upstream_runs
+    :param reached: optional list, to which the outermost stop cells within the catchment are appended
+    :return: arrays (xs, ys) of all cells in the catchment, or None if the pour point is not indexed
+    """
+
+    found = upstream_runs(index, x, y, stop)
+    if found is None:
+        return None
+    runs, outermost = found
+    if reached is not None:
+        reached.extend(outermost)
+
+    cells = np.concatenate([np.asarray(index.order[a:b], dtype=np.int64) for a, b in runs])
+    ys, xs = np.divmod(cells, index.rank.shape[1])
+    return xs, ys
+
+
+def outermost_cells(index, cells):
+    """The (x, y) cells that are not upstream of any other of the cells"""
+    cells = sorted(cells, key=lambda cell: int(index.rank[cell[1], cell[0]]))
+    outermost = []
+    end = -1
+    for x, y in cells:
+        rank = int(index.rank[y, x])
+        if rank >= end:
+            outermost.append((x, y))
+            end = rank + int(index.size[y, x])
+    return outermost
@@ -1,10 +1,22 @@
-from osgeo import gdal
-import fiona
 from shapely.geometry import mapping
-from matplotlib.path import Path
-import rasterio
 import rasterio.mask as rmask
 
+from . import datasets
+from .rasters import open_raster, open_rasterio
+
+# D8 code each neighbor of a 3x3 window must have to drain into the center cell
+contributions = {
+    (0, 0): 2,
+    (0, 1): 4,
+    (0, 2): 8,
+    (1, 0): 1,
+    (1, 1): 0,
+    (1, 2): 16,
+    (2, 0): 128,
+    (2, 1): 64,
+    (2, 2): 32
+}
+
 
 def lonlat2xy(lon, lat, gt):
     """Convert the map coordinates (lon, lat) to grid coordinates (x, y)"""
@@ -70,7 +82,7 @@ def get_grid_region(point, bilpath, cell_size):
 
         # create the gdal flow direction grid from the bil
         try:
-            bil = gdal.Open(bilpath.format(region, cell_size))
+            bil = open_raster(bilpath, region, cell_size)
         except:
             print('ERROR: path not found: {}'.format(bilpath))
             raise
@@ -91,20 +103,14 @@ def get_grid_region(point, bilpath, cell_size):
     return region
 
 
-def find_hydrobasins_region(PATH, regions, point):
+def find_hydrobasins_region(rootpath, regions, point):
     for region in regions:
-        path = PATH.format(r=region, l=1, e='shp')
-        with fiona.open(path) as shapes:
-            feature = next(iter(shapes))
-            polygons = feature['geometry']['coordinates']
-            for polygon in polygons:
-                for subpolygon in polygon:
-                    path = Path(subpolygon, closed=True)
-                    if path.contains_point(point):
-                        return region
-
-
-def get_region01(PATH, point):
+        if not datasets.locate_basins(rootpath, region, 1, point).empty:
+            return region
+
+
+def region01_candidates(point):
+    """HydroBASINS regions to search for a point, in order of priority"""
     regions = ['as', 'af', 'eu', 'na', 'sa', 'au']
 
     lng, lat = point
@@ -122,12 +128,29 @@ def get_region01(PATH, point):
     elif -140 < lng < -52 and 7 < lat < 62:
         regions = ['na', 'sa']
 
-    region01 = find_hydrobasins_region(PATH, regions, point)
+    return regions
+
+
+def get_region01(rootpath, point):
+    region01 = find_hydrobasins_region(rootpath, region01_candidates(point), point)
 
     return region01
 
 
-def get_delineation_mode(accpath, point, basins, feature, region, cell_size):
+def max_accumulation(src, geometries):
+    """Maximum flow accumulation within the geometries, from an open rasterio dataset"""
+    features = [mapping(geometry) for geometry in geometries]
+    up_acc_area, up_acc_transform = rmask.mask(src, features, crop=True)
+    return up_acc_area.max()
+
+
+def get_delineation_mode(accpath, point, basins, feature, region, cell_size, max_acc=None):
+    """
+    Choose hybrid or traditional delineation for a point in a basin.
+
+    :param max_acc: optional table of precomputed maximum accumulation, indexed by HYBAS_ID with a column per grid
+        region
+    """
     lng, lat = point
 
     # routine to find max upstream flow accumulation
@@ -141,17 +164,21 @@ def get_delineation_mode(accpath, point, basins, feature, region, cell_size):
     else:
 
         # get point acc
-        bil = gdal.Open(accpath.format(region, cell_size))
+        bil = open_raster(accpath, region, cell_size)
         acc = bil.GetRasterBand(1)
         gt = bil.GetGeoTransform()
         x, y = lonlat2xy(lng, lat, gt)
         point_acc = acc.ReadAsArray(x, y, 1, 1)[0][0]
 
-        # get up acc
-        features = [mapping(row['geometry']) for i, row in next_ups.iterrows()]
-        with rasterio.open(accpath.format(region, cell_size)) as src:
-            up_acc_area, up_acc_transform = rmask.mask(src, features, crop=True)
-        max_up_acc = up_acc_area.max()
+        # get up acc, from the precomputed table if it covers all the upstream basins
+        max_up_acc = None
+        if max_acc is not None and region in max_acc.columns:
+            up_accs = max_acc[region].reindex(next_ups['HYBAS_ID'])
+            if not up_accs.isnull().any():
+                max_up_acc = up_accs.max()
+        if max_up_acc is None:
+            src = open_rasterio(accpath, region, cell_size)
+            max_up_acc = max_accumulation(src, next_ups['geometry'])
 
         if max_up_acc > point_acc:
             mode = 'traditional'
@@ -159,3 +186,9 @@ def get_delineation_mode(accpath, point, basins, feature, region, cell_size):
             mode = 'hybrid'
 
     return mode
+
+
+def count_vertices(geometry):
+    """Number of vertices in a Polygon or MultiPolygon, counting every ring"""
+    polygons = getattr(geometry, 'geoms', [geometry])
+    return sum(len(p.exterior.coords) + sum(len(r.coords) for r in p.interiors) for p in polygons)
@@ -0,0 +1,73 @@
+import os
+import random
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+# seconds to wait for a connection and for the response
+CONNECT_TIMEOUT = float(os.environ.get('CUENCAS_DELIVERY_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('CUENCAS_DELIVERY_READ_TIMEOUT', 30))
+
+MAX_RETRIES = int(os.environ.get('CUENCAS_DELIVERY_RETRIES', 8))
+BACKOFF_BASE = float(os.environ.get('CUENCAS_DELIVERY_BACKOFF', 2))
+BACKOFF_MAX = float(os.environ.get('CUENCAS_DELIVERY_BACKOFF_MAX', 600))
+
+# keep-alive connections kept per destination host
+POOL_SIZE = int(os.environ.get('CUENCAS_DELIVERY_POOL_SIZE', 4))
+
+# batched results wait this many seconds for others to the same dest, and at most this many are sent together
+BATCH_WINDOW = float(os.environ.get('CUENCAS_DELIVERY_BATCH_WINDOW', 5))
+BATCH_SIZE = int(os.environ.get('CUENCAS_DELIVERY_BATCH_SIZE', 50))
+
+_sessions = {}
+_pid = None
+
+
+def get_session(dest):
+    """A keep-alive session for the host of dest, one per host per process"""
+    global _pid
+    if _pid != os.getpid():
+        _sessions.clear()
+        _pid = os.getpid()
+    host = urlsplit(dest).netloc
+    if host not in _sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions[host] = session
+    return _sessions[host]
+
+
+def post(dest, payload):
+    """Post a payload to dest, raising requests.RequestException on failure"""
+    response = get_session(dest).post(dest, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    response.raise_for_status()
+    return response
+
+
+def backoff(retries):
+    """Seconds to wait before retry number retries + 1: exponential, capped, with jitter"""
+    delay = min(BACKOFF_BASE ** (retries + 1), BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def add_to_outbox(outbox, dest, payload):
+    outbox.insert_one({'dest': dest, 'payload': payload, 'created': datetime.utcnow()})
+
+
+def take_from_outbox(outbox, dest, limit=BATCH_SIZE):
+    """Remove and return up to limit waiting payloads for dest, oldest first"""
+    payloads = []
+    for i in range(limit):
+        item = outbox.find_one_and_delete({'dest': dest}, sort=[('created', 1)])
+        if item is None:
+            break
+        payloads.append(item['payload'])
+    return payloads
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+# the running totals of every process are kept in one document of the metrics collection
+TOTALS_ID = 'totals'
+
+HELP = OrderedDict([
+    ('delineations', 'Delineation requests, by how they were served'),
+    ('stage_seconds', 'Seconds spent in each stage of a delineation'),
+    ('cells_visited', 'Flow direction grid cells in traced catchments'),
+    ('gdal_reads', 'Flow direction grid blocks read while tracing'),
+    ('polygons_unioned', 'Polygons dissolved into delineations'),
+    ('vertices', 'Vertices in delineated geometries'),
+    ('tiles_spilled', 'Visited cell tiles spilled to disk by bounded traces'),
+])
+
+
+def record(collection, trace, result):
+    """
+    Add one delineation's trace to the running totals.
+
+    :param collection: the Mongo metrics collection, shared by the web app and all workers
+    :param trace: delineation.profiling.Trace
+    :param result: how the request was served, e.g., 'hybrid', 'traditional', 'cached' or 'failed'
+    """
+    inc = {'delineations.{}'.format(result): 1}
+    for stage, seconds in trace.timings.items():
+        inc['stage_seconds.{}'.format(stage)] = seconds
+        inc['stage_calls.{}'.format(stage)] = 1
+    for name, n in trace.counts.items():
+        inc['counts.{}'.format(name)] = n
+    collection.update_one({'_id': TOTALS_ID}, {'$inc': inc}, upsert=True)
+
+
+def render(collection):
+    """The running totals in the Prometheus text exposition format"""
+    totals = collection.find_one({'_id': TOTALS_ID}) or {}
+    lines = []
+
+    def add(name, kind, samples):
+        # in the 0.0.4 text format, only summaries and histograms have samples with suffixes to their declared name, so
+        # counters are declared by their full sample name
+        metric = 'cuencas_{}{}'.format(name, '_total' if kind == 'counter' else '')
+        lines.append('# HELP {} {}'.format(metric, HELP.get(name, name.replace('_', ' ').capitalize())))
+        lines.append('# TYPE {} {}'.format(metric, kind))
+        for suffix, labels, value in samples:
+            label = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append('{}{}{} {}'.format(metric, suffix, '{' + label + '}' if label else '', value))
+
+    delineations = totals.get('delineations', {})
+    add('delineations', 'counter', [('', [('result', r)], n) for r, n in sorted(delineations.items())])
+
+    seconds = totals.get('stage_seconds', {})
+    calls = totals.get('stage_calls', {})
+    samples = []
+    for stage in sorted(seconds):
+        samples.append(('_sum', [('stage', stage)], seconds[stage]))
+        samples.append(('_count', [('stage', stage)], calls.get(stage, 0)))
+    add('stage_seconds', 'summary', samples)
+
+    for name, n in sorted(totals.get('counts', {}).items()):
+        add(name, 'counter', [('', [], n)])
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,106 @@
+import os, argparse
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from delineation import datasets
+from delineation.basin_search import delineate_from_basins
+from delineation.region_lookup import build_region_lookup, lookup_path
+from delineation.upstream_index import build_upstream_index, index_paths
+from delineation.utils import max_accumulation
+
+GRID_REGIONS = ['af', 'as', 'au', 'ca', 'eu', 'na', 'sa']
+BASIN_REGIONS = ['af', 'ar', 'as', 'au', 'eu', 'na', 'sa', 'si']
+
+
+def build_indexes(path, regions, cell_size=15):
+    for region in regions:
+        bilpath = os.path.join(path, 'hydrosheds', '{}_dir_{}s.bil'.format(region, cell_size))
+        if not os.path.exists(bilpath):
+            print('Skipping upstream index for {}: no flow direction grid'.format(region))
+            continue
+        if all(os.path.exists(p) for p in index_paths(bilpath).values()):
+            continue
+        print('Building upstream index for {}'.format(region))
+        build_upstream_index(bilpath)
+
+
+def build_max_acc(path, regions, max_level=7, cell_size=15):
+    """Tabulate the maximum flow accumulation in each basin, per level and per HydroSHEDS grid"""
+    grids = {}
+    for grid_region in GRID_REGIONS:
+        accpath = os.path.join(path, 'hydrosheds', '{}_acc_{}s.bil'.format(grid_region, cell_size))
+        if os.path.exists(accpath):
+            grids[grid_region] = rasterio.open(accpath)
+
+    for region in regions:
+        h5path = datasets.h5_path(path, region)
+        if not os.path.exists(h5path):
+            continue
+        with pd.HDFStore(h5path) as store:
+            done = store.keys()
+        for level in range(1, max_level + 1):
+            key = 'maxacc{:02}'.format(level)
+            if '/' + key in done:
+                continue
+            print('Tabulating maximum flow accumulation for {} level {}'.format(region, level))
+            basins = datasets.get_basins(path, region, level)
+            table = pd.DataFrame(index=pd.Index(basins['HYBAS_ID'].values, name='HYBAS_ID'))
+            for grid_region, src in grids.items():
+                left, bottom, right, top = src.bounds
+                values = []
+                for geometry in basins['geometry']:
+                    minx, miny, maxx, maxy = geometry.bounds
+                    if maxx < left or minx > right or maxy < bottom or miny > top:
+                        values.append(np.nan)
+                        continue
+                    try:
+                        values.append(max_accumulation(src, [geometry]))
+                    except ValueError:  # no overlap with the grid
+                        values.append(np.nan)
+                table[grid_region] = values
+            table.to_hdf(h5path, key)
+
+    for src in grids.values():
+        src.close()
+
+
+def prefill_unions(path, regions, count, max_level=7, omit_sinks=True):
+    """Compute the HydroBASINS part of hybrid delineations for the pour basins with the largest upstream area"""
+    for region in regions:
+        if not os.path.exists(datasets.basins_path(path, region, max_level)):
+            continue
+        print('Dissolving upstream basins for {}'.format(region))
+        hydrobasins = {level: datasets.get_basins(path, region, level) for level in range(1, max_level + 1)}
+        largest = hydrobasins[max_level].sort_values('UP_AREA', ascending=False).iloc[:count]
+        for i in range(len(largest)):
+            feature0x = largest.iloc[[i]]
+            point = feature0x.iloc[0]['geometry'].representative_point()
+            delineate_from_basins(path, (point.x, point.y), hydrobasins, region, feature0x, max_level, omit_sinks)
+
+
+def main(path, regions, unions):
+    print("preprocessing...")
+    if not os.path.exists(lookup_path(path)):
+        print('Building region lookup grid')
+        build_region_lookup(path)
+    build_indexes(path, [r for r in regions if r in GRID_REGIONS])
+    build_max_acc(path, [r for r in regions if r in BASIN_REGIONS])
+    if unions:
+        prefill_unions(path, [r for r in regions if r in BASIN_REGIONS], unions)
+    print('Finished')
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--path', default=os.environ.get('CUENCAS_PATH', './data'),
+                        help='''Path (local) or region (efs)''')
+    parser.add_argument('-r', '--regions', nargs='+', default=sorted(set(GRID_REGIONS + BASIN_REGIONS)),
+                        help='''HydroSHEDS and HydroBASINS regions to preprocess''')
+    parser.add_argument('-u', '--unions', type=int, default=50,
+                        help='''Number of largest basins per region to dissolve in advance''')
+    args = parser.parse_args()
+
+    main(args.path, args.regions, args.unions)
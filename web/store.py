@@ -0,0 +1,289 @@
+import os
+import hashlib
+import socket
+import zlib
+from functools import partial
+from datetime import datetime, timedelta
+
+import gridfs
+from bson.binary import Binary
+from pymongo import MongoClient, ASCENDING, DESCENDING, GEO2D
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from shapely import wkb
+from shapely.geometry import mapping, shape
+
+from delineation.formats import resolutions
+from delineation.utils import count_vertices
+
+# unused results are dropped after this many seconds
+CACHE_TTL = int(os.environ.get('CUENCAS_CACHE_TTL', 30 * 24 * 3600))
+
+# least recently used results are dropped when the collection grows beyond this size
+CACHE_MB = int(os.environ.get('CUENCAS_CACHE_MB', 2048))
+
+# Mongo's document limit is 16 MB; larger geometries are stored in chunks, in the 'large' GridFS bucket
+MAX_GEOMETRY_BYTES = 15 * 1024 * 1024
+
+# a task delineating a key claims it for this many seconds, so identical requests wait for its result instead of
+# computing it again; the claim lapses if the task dies
+CLAIM_TTL = int(os.environ.get('CUENCAS_CLAIM_TTL', 600))
+
+# seconds between checks for a claimed result
+CLAIM_POLL = float(os.environ.get('CUENCAS_CLAIM_POLL', 2))
+
+# at most this many saved catchments are considered for reuse upstream of a new outlet, largest first
+UPSTREAM_CANDIDATES = int(os.environ.get('CUENCAS_UPSTREAM_CANDIDATES', 1000))
+UPSTREAM_MAX_DEGREES = float(os.environ.get('CUENCAS_UPSTREAM_MAX_DEGREES', 5))
+
+# job records of queued requests are kept this many seconds
+JOB_TTL = int(os.environ.get('CUENCAS_JOB_TTL', 24 * 3600))
+
+
+class Pending(Exception):
+    """The delineation is being computed by another task"""
+
+    def __init__(self, uuid):
+        super(Pending, self).__init__('delineation {} is in progress'.format(uuid))
+        self.uuid = uuid
+
+
+def cache_key(grid_region, region01, x, y, cell_size=15, max_level=7, omit_sinks=True, merge='vector'):
+    """Key of a delineation: the pour cell it starts from and the parameters that change its result"""
+    string = '{}_{}_{}_{}_{}_{}_{}'.format(grid_region, region01, x, y, cell_size, max_level, omit_sinks)
+    if merge != 'vector':
+        string += '_{}'.format(merge)  # keys of vector merges predate the option
+    return hashlib.md5(string.encode()).hexdigest()
+
+
+def encode_geometry(geometry):
+    return Binary(zlib.compress(wkb.dumps(geometry)))
+
+
+def decode_geometry(data):
+    return wkb.loads(zlib.decompress(data))
+
+
+class ResultStore(object):
+    """
+    Delineations saved in Mongo, keyed by cache_key.
+
+    Geometries are stored as zlib-compressed WKB alongside a small metadata record, or in GridFS if too large for the
+    record. Results expire CACHE_TTL seconds after they were last used, and the least recently used are evicted when
+    the collection exceeds CACHE_MB.
+
+    Each process gets its own pooled client, created on first use, since clients cannot be shared across a fork.
+    """
+
+    def __init__(self, url, database='cuencasdb', ttl=CACHE_TTL, max_mb=CACHE_MB):
+        self.url = url
+        self.database = database
+        self.ttl = ttl
+        self.max_bytes = max_mb * 1024 * 1024
+        self.pid = None
+        self.client = None
+
+    @property
+    def db(self):
+        if self.client is None or self.pid != os.getpid():
+            self.client = MongoClient(self.url)
+            self.pid = os.getpid()
+            self.ensure_indexes()
+        return self.client[self.database]
+
+    @property
+    def delineations(self):
+        return self.db.delineations
+
+    @property
+    def large(self):
+        """Geometries too large for a document, in GridFS"""
+        return gridfs.GridFS(self.db, 'large')
+
+    def ensure_indexes(self):
+        delineations = self.client[self.database].delineations
+        try:
+            delineations.create_index([('uuid', ASCENDING)], unique=True)
+        except OperationFailure as ex:
+            # e.g., duplicate uuids saved before the index existed
+            print('WARNING: could not create unique index on delineations.uuid: {}'.format(ex))
+        self.ensure_ttl_index(delineations, 'accessed', self.ttl)
+        delineations.create_index([('outlet.lonlat', GEO2D), ('outlet.grid_region', ASCENDING)])
+        delineations.create_index([('wkb_file', ASCENDING)], sparse=True)
+        self.client[self.database].outbox.create_index([('dest', ASCENDING), ('created', ASCENDING)])
+        self.ensure_ttl_index(self.client[self.database].claims, 'expires', 0)
+        self.ensure_ttl_index(self.client[self.database].jobs, 'created', JOB_TTL)
+
+    def ensure_ttl_index(self, collection, field, seconds):
+        """Create a TTL index, or update its expiry if it was created with another, e.g., before a setting changed"""
+        try:
+            collection.create_index([(field, ASCENDING)], expireAfterSeconds=seconds)
+        except OperationFailure:
+            try:
+                self.client[self.database].command('collMod', collection.name,
+                                                   index={'keyPattern': {field: 1}, 'expireAfterSeconds': seconds})
+            except OperationFailure as ex:
+                print('WARNING: could not set expiry of {}.{} to {} s: {}'.format(collection.name, field, seconds, ex))
+
+    def claim(self, uuid, ttl=CLAIM_TTL):
+        """
+        Claim a key to delineate it, returning True if no one else holds an unexpired claim on it.
+
+        The claim is a single upsert that only matches an expired claim: if an unexpired one exists, the upsert tries
+        to insert a second document with the same _id and fails.
+        """
+        now = datetime.utcnow()
+        owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        try:
+            self.db.claims.update_one({'_id': uuid, 'expires': {'$lt': now}},
+                                      {'$set': {'owner': owner, 'expires': now + timedelta(seconds=ttl)}},
+                                      upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def release(self, uuid):
+        self.db.claims.delete_one({'_id': uuid})
+
+    def create_job(self, job_id, **fields):
+        """Record a queued request, to be polled by its job id"""
+        self.db.jobs.insert_one(dict(fields, _id=job_id, status='queued', created=datetime.utcnow()))
+
+    def update_job(self, job_id, **fields):
+        self.db.jobs.update_one({'_id': job_id}, {'$set': fields})
+
+    def find_job(self, job_id):
+        return self.db.jobs.find_one({'_id': job_id})
+
+    def exists(self, uuid):
+        return self.delineations.find_one({'uuid': uuid}, {'_id': True}) is not None
+
+    def find(self, uuid, resolution='full'):
+        """
+        The saved GeoJSON feature for a key, or None.
+
+        :param resolution: 'full', or one of the pre-simplified formats.RESOLUTIONS, if the geometry needed one
+        """
+        field = 'wkb' if resolution == 'full' else 'resolutions.{}'.format(resolution)
+        delineation = self.delineations.find_one_and_update({'uuid': uuid}, {'$set': {'accessed': datetime.utcnow()}},
+                                                            projection={field: True, 'properties': True,
+                                                                        'geojson': True, 'wkb_file': True})
+        if delineation is None:
+            return None
+        if 'geojson' in delineation:
+            return delineation['geojson']  # saved before geometries were compressed
+        data = delineation.get('wkb') or delineation.get('resolutions', {}).get(resolution)
+        if data is None and 'wkb_file' in delineation:
+            try:
+                data = self.large.get(delineation['wkb_file']).read()
+            except gridfs.NoFile:
+                return None
+        if data is None:
+            # small enough to need no simplified version
+            data = self.delineations.find_one({'uuid': uuid}, {'wkb': True})['wkb']
+        return {
+            'type': 'Feature',
+            'geometry': mapping(decode_geometry(data)),
+            'properties': delineation.get('properties', {})
+        }
+
+    def find_geometry(self, uuid, field='wkb'):
+        """The saved geometry for a key, as a shapely geometry, or None; field='footprint' for its grid cells"""
+        delineation = self.delineations.find_one({'uuid': uuid}, {field: True})
+        if delineation is None or field not in delineation:
+            return None
+        return decode_geometry(delineation[field])
+
+    def find_upstream(self, grid_region, cell_size, lonlat, cells):
+        """
+        Saved catchments that may be upstream of an outlet with the given number of upstream cells: traditional
+        delineations on the same grid, with fewer upstream cells and outlets close enough to be among them.
+
+        Only traditional delineations saved with their footprint, the unsimplified polygon of their grid cells, are
+        reused: simplified, buffered or HydroBASINS edges would not line up with the cells traced around them.
+
+        :return: dict of (x, y) outlet cells to functions loading their footprints, as taken by delineate()
+        """
+        lon, lat = lonlat
+        max_distance = min(cells * cell_size / 3600, UPSTREAM_MAX_DEGREES)
+        saved = self.delineations.find({
+            'outlet.lonlat': {'$geoWithin': {'$box': [[lon - max_distance, lat - max_distance],
+                                                      [lon + max_distance, lat + max_distance]]}},
+            'outlet.grid_region': grid_region,
+            'outlet.cell_size': cell_size,
+            'outlet.cells': {'$lt': cells},
+            'meta.mode': 'traditional',
+            'footprint': {'$exists': True},
+        }, {'uuid': True, 'outlet.x': True, 'outlet.y': True})
+        saved = saved.sort('outlet.cells', DESCENDING).limit(UPSTREAM_CANDIDATES)
+        return {(d['outlet']['x'], d['outlet']['y']): partial(self.find_geometry, d['uuid'], 'footprint')
+                for d in saved}
+
+    def save(self, uuid, feature, mode=None, trace=None, outlet=None, footprint=None):
+        """
+        Save a delineation, with its mode and, if given, the profiling.Trace of how it was computed. Simplified
+        versions are saved too, for the resolutions the geometry has too many vertices for.
+
+        :param outlet: optional dict of the pour cell: grid_region, cell_size, x, y, cells upstream and lonlat, so that
+            the delineation can be reused by outlets downstream
+        :param footprint: optional unsimplified polygon of the grid cells of a traditional delineation, as reused by
+            outlets downstream; dropped if it does not fit in the document along with the geometry
+        """
+        geometry = shape(feature['geometry'])
+        data = encode_geometry(geometry)
+        simplified = {name: encode_geometry(g) for name, g in resolutions(geometry).items()}
+        nbytes = sum(len(d) for d in simplified.values())
+        document = {}
+        if nbytes + len(data) > MAX_GEOMETRY_BYTES:
+            # still saved, so that tasks waiting for this key find it rather than delineating it again
+            document['wkb_file'] = self.large.put(data, uuid=uuid)
+        else:
+            document['wkb'] = data
+            if footprint is not None:
+                cells = encode_geometry(footprint)
+                if nbytes + len(data) + len(cells) <= MAX_GEOMETRY_BYTES:
+                    document['footprint'] = cells
+                    nbytes += len(cells)
+        nbytes += len(data)
+        now = datetime.utcnow()
+        self.delineations.replace_one({'uuid': uuid}, dict(document, **{
+            'uuid': uuid,
+            'resolutions': simplified,
+            'outlet': outlet,
+            'properties': feature.get('properties', {}),
+            'meta': {
+                'area': geometry.area,
+                'bbox': list(geometry.bounds),
+                'vertices': count_vertices(geometry),
+                'mode': mode,
+                'trace': trace.to_dict() if trace is not None else None,
+            },
+            'nbytes': nbytes,
+            'created': now,
+            'accessed': now,
+        }), upsert=True)
+        self.evict()
+
+    def evict(self):
+        """Drop the least recently used results until the collection, with its large geometries, fits in its budget"""
+        # large geometries of results that have expired or been replaced, leaving time for those being saved
+        uploaded = datetime.utcnow() - timedelta(seconds=CLAIM_TTL)
+        for large in self.db['large.files'].find({'uploadDate': {'$lt': uploaded}}, {'_id': True}):
+            if self.delineations.find_one({'wkb_file': large['_id']}, {'_id': True}) is None:
+                self.large.delete(large['_id'])
+
+        size = 0
+        for collection in ['delineations', 'large.chunks']:
+            try:
+                size += self.db.command('collstats', collection).get('size', 0)
+            except OperationFailure:
+                pass  # not created yet
+        excess = size - self.max_bytes
+        if excess <= 0:
+            return
+        stale = []
+        for delineation in self.delineations.find({}, {'nbytes': True}).sort('accessed', ASCENDING):
+            stale.append(delineation['_id'])
+            excess -= delineation.get('nbytes', 0) + 200  # metadata overhead
+            if excess <= 0:
+                break
+        self.delineations.delete_many({'_id': {'$in': stale}})
@@ -0,0 +1,44 @@
+import numpy as np
+from shapely.geometry import Point, box
+from shapely.ops import cascaded_union
+
+from delineation.grid_search import rasterize_mask
+from delineation.utils import xy2lonlat
+
+# a 15 arc-second grid, as the flow direction grids are
+GT = (-100.0, 1 / 240, 0.0, 40.0, 0.0, -1 / 240)
+
+
+def grid_aligned_polygon(rows=30, cols=40, seed=0):
+    """A blob of whole grid cells with ragged edges and a hole, as HydroBASINS polygons follow the edges of cells"""
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[:rows, :cols]
+    radius = 10 + 3 * rng.rand(rows, cols)
+    cells = np.hypot(yy - rows / 2, xx - cols / 2) < radius
+    cells[13:16, 18:22] = False
+    squares = []
+    for y, x in zip(*np.nonzero(cells)):
+        lon, lat = xy2lonlat(x + 5, y + 5, GT)
+        squares.append(box(lon, lat + GT[5], lon + GT[1], lat))
+    return cascaded_union(squares)
+
+
+def check_rasterize_mask(centers):
+    mask = grid_aligned_polygon()
+    x0, y0, array = rasterize_mask(mask, GT, 60, 50, centers=centers)
+    offset = 0.5 if centers else 0
+    expected = np.zeros_like(array)
+    for row in range(array.shape[0]):
+        for col in range(array.shape[1]):
+            lon, lat = xy2lonlat(x0 + col + offset, y0 + row + offset, GT)
+            expected[row, col] = mask.contains(Point(lon, lat))
+    assert expected.any()
+    assert (array == expected).all()
+
+
+def test_rasterize_mask_matches_contains_at_corners():
+    check_rasterize_mask(centers=False)
+
+
+def test_rasterize_mask_matches_contains_at_centers():
+    check_rasterize_mask(centers=True)
@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+
+from delineation.grid_search import TiledMask
+from delineation.tiled_trace import BitsetTiles
+
+
+def test_bitset_tiles_match_tiled_mask():
+    rows, cols, tile_size = 50, 70, 16
+    rng = np.random.RandomState(0)
+    mask = TiledMask(cols, rows, tile_size)
+    # room for two tiles in memory, so that most are spilled to disk and read back
+    bitsets = BitsetTiles(cols, rows, tile_size, max_bytes=2 * tile_size * tile_size // 8)
+    try:
+        for i in range(40):
+            n = rng.randint(1, 200)
+            ys = rng.randint(0, rows, n)
+            xs = rng.randint(0, cols, n)
+            assert (bitsets.get(ys, xs) == mask.get(ys, xs)).all()
+            mask.set(ys, xs)
+            bitsets.set(ys, xs)
+            assert bitsets.get(ys, xs).all()
+
+        assert bitsets.spills > 0
+        assert bitsets.keys() == sorted(mask.tiles)
+        for key in bitsets.keys():
+            assert (bitsets.array(key) == mask.tiles[key]).all()
+
+        ys, xs = np.divmod(np.arange(rows * cols), cols)
+        assert (bitsets.get(ys, xs) == mask.get(ys, xs)).all()
+    finally:
+        path = bitsets.path
+        bitsets.close()
+    assert path is not None and not os.path.exists(path)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+from delineation.topology import BasinTopology
+
+
+def random_basins(n=60, seed=0):
+    """
+    A random HydroBASINS-like layer of one main basin: a tree of NEXT_DOWN links to an outlet, with a few inner sinks.
+    Every basin's NEXT_SINK is the nearest sink at or below it, so sinks, the outlet among them, are their own
+    NEXT_SINK.
+    """
+    rng = np.random.RandomState(seed)
+    ids = 1000 + np.arange(n)
+    parent = np.r_[-1, [rng.randint(0, i) for i in range(1, n)]]
+    sink = rng.rand(n) < 0.1
+    sink[0] = True
+
+    next_sink = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        j = i
+        while not sink[j]:
+            j = parent[j]
+        next_sink[i] = ids[j]
+
+    # shuffle rows, since the chain walk and the topology must not depend on the layer's order
+    rows = rng.permutation(n)
+    return pd.DataFrame({
+        'HYBAS_ID': ids[rows],
+        'NEXT_DOWN': np.where(parent >= 0, ids[np.maximum(parent, 0)], 0)[rows],
+        'NEXT_SINK': next_sink[rows],
+        'MAIN_BAS': np.full(n, ids[0])[rows],
+    })
+
+
+def chain_walk(basins, this_basin_id, omit_sinks):
+    """The chain walk get_basins used before BasinTopology, stopping where a basin drains to itself"""
+    to_include = []
+    searched = []
+    for i, subbasin in basins.iterrows():
+        if omit_sinks:
+            next_down = subbasin['NEXT_DOWN']
+        else:
+            next_down = subbasin['NEXT_SINK']
+        if omit_sinks and subbasin['MAIN_BAS'] != subbasin['NEXT_SINK']:
+            searched.append(subbasin['HYBAS_ID'])
+            continue
+        subbasin_chain = [subbasin['HYBAS_ID']]
+        if subbasin['HYBAS_ID'] in to_include:
+            continue
+        while next_down:
+            if next_down == this_basin_id or next_down in to_include:
+                to_include.extend(subbasin_chain)
+                searched.extend(subbasin_chain)
+                break
+
+            down_basin = basins.loc[basins['HYBAS_ID'] == next_down]
+            if down_basin.empty or next_down in subbasin_chain:
+                break
+            down_basin_props = down_basin.iloc[0]
+            subbasin_chain.append(down_basin_props['HYBAS_ID'])
+            if omit_sinks:
+                next_down = down_basin_props['NEXT_DOWN']
+            else:
+                next_down = down_basin_props['NEXT_SINK']
+    return set(to_include), set(searched)
+
+
+def check_contributing(basins, seed, omit_sinks):
+    topology = BasinTopology(basins)
+    rng = np.random.RandomState(seed)
+    for target in range(len(basins)):
+        candidates = rng.rand(len(basins)) < 0.8
+        candidates[target] = True
+
+        included, searched = topology.contributing(target, candidates, omit_sinks)
+        expected_included, expected_searched = chain_walk(basins.loc[candidates], topology.ids[target], omit_sinks)
+        assert set(topology.ids[included]) == expected_included
+        assert set(topology.ids[searched]) == expected_searched
+
+
+def test_contributing_matches_chain_walk():
+    check_contributing(random_basins(), seed=1, omit_sinks=True)
+
+
+def test_contributing_matches_chain_walk_following_sinks():
+    basins = random_basins()
+    check_contributing(basins, seed=2, omit_sinks=False)
+
+    # a sink is its own NEXT_SINK, and so contributes to itself
+    topology = BasinTopology(basins)
+    outlet = int(np.flatnonzero(topology.ids == 1000)[0])
+    included, searched = topology.contributing(outlet, np.ones(len(basins), dtype=bool), omit_sinks=False)
+    assert included[outlet]
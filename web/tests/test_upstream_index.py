@@ -0,0 +1,78 @@
+import numpy as np
+
+from delineation.grid_search import TiledGrid, stop_filter, trace_upstream
+from delineation.upstream_index import index_arrays, upstream_cells
+from delineation.utils import contributions
+
+
+class ArrayBand(object):
+    """Stands in for a GDAL raster band over an in-memory array"""
+
+    def __init__(self, array):
+        self.array = array
+        self.YSize, self.XSize = array.shape
+
+    def ReadAsArray(self, x0, y0, cols, rows):
+        return self.array[y0:y0 + rows, x0:x0 + cols].copy()
+
+
+def random_fdir(rows=23, cols=31, seed=0):
+    """Random D8 codes, including sinks (0), nodata (255), flow loops and cells draining off the grid"""
+    rng = np.random.RandomState(seed)
+    codes = np.array([code for code in contributions.values() if code] + [0, 255])
+    weights = np.r_[np.full(8, 0.97 / 8), 0.02, 0.01]
+    return rng.choice(codes, size=(rows, cols), p=weights).astype(np.uint8)
+
+
+def river_fdir(rows=23, cols=31):
+    """Every column flows south to the bottom row, which flows east off the grid: one tree with no loops"""
+    fdir = np.full((rows, cols), 4, dtype=np.uint8)
+    fdir[-1, :] = 1
+    return fdir
+
+
+def cellset(xs, ys):
+    return set(zip(xs.tolist(), ys.tolist()))
+
+
+def check_all_cells(fdir):
+    index = index_arrays(fdir)
+    grid = TiledGrid(ArrayBand(fdir), tile_size=8)
+    rows, cols = fdir.shape
+    for y in range(rows):
+        for x in range(cols):
+            found = upstream_cells(index, x, y)
+            if index.rank[y, x] < 0:
+                # cells in flow loops are not indexed
+                assert found is None
+                continue
+            assert cellset(*found) == cellset(*trace_upstream(grid, x, y))
+            assert len(found[0]) == index.size[y, x]
+
+
+def test_upstream_cells_match_trace_on_random_grid():
+    check_all_cells(random_fdir())
+
+
+def test_upstream_cells_match_trace_on_river():
+    fdir = river_fdir()
+    check_all_cells(fdir)
+    assert index_arrays(fdir).size[-1, -1] == fdir.size
+
+
+def test_upstream_cells_with_stops_match_trace():
+    fdir = river_fdir()
+    index = index_arrays(fdir)
+    grid = TiledGrid(ArrayBand(fdir), tile_size=8)
+    rows, cols = fdir.shape
+
+    # a column above the bottom row, a cell upstream of it, another column, a cell off the catchment and the pour point
+    x, y = cols - 2, rows - 1
+    stop = [(3, rows - 2), (3, 5), (15, 2), (cols - 1, 4), (x, y)]
+    reached = []
+    xs, ys = upstream_cells(index, x, y, stop=stop, reached=reached)
+
+    found = []
+    expected = trace_upstream(grid, x, y, include=stop_filter(stop, cols, found))
+    assert cellset(xs, ys) == cellset(*expected)
+    assert sorted(reached) == sorted(found) == [(3, rows - 2), (15, 2)]